@@ -1,10 +1,23 @@
 import os
 import secrets
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, session, jsonify
+from flask import Flask, Response, g, request, render_template, session, jsonify, stream_with_context
 import requests
 import logging
+import logging.handlers
+import atexit
+import queue
+import random
 import json
+import time
+import click
+import metrics
+from context_builder import ContextBuilder, load_token_counter
+from history_store import HistoryStore
+from response_cache import ResponseCache
+from scheduler import SchedulerOverloaded, UpstreamScheduler
+from session_store import MemorySessionBackend, ServerSideSessionInterface, SQLiteSessionBackend
+from upstream import CircuitBreaker, UpstreamClient, UpstreamUnavailable
 
 # Load environment variables from .env
 load_dotenv()
@@ -15,60 +28,194 @@ app = Flask(__name__, static_folder='static', template_folder='templates')
 # Get SECRET_KEY from the environment, or fall back to a secure random key
 app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(32))
 
+# Keep session data on the server; the cookie only carries a signed session id
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+if os.getenv('SESSION_BACKEND', 'sqlite') == 'memory':
+    session_backend = MemorySessionBackend(max_entries=int(os.getenv('SESSION_MAX_ENTRIES', '10000')),
+                                           ttl=SESSION_TTL)
+else:
+    session_backend = SQLiteSessionBackend(os.getenv('SESSION_DB', 'sessions.db'), ttl=SESSION_TTL)
+app.session_interface = ServerSideSessionInterface(session_backend)
+
 # Load HuggingFace API token from .env
 API_TOKEN = os.getenv('HUGGINGFACE_API_TOKEN')
-API_URL = 'https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-Instruct-v0.1'
+API_URL = os.getenv('HUGGINGFACE_API_URL',
+                    'https://api-inference.huggingface.co/models/mistralai/Mixtral-8x7B-Instruct-v0.1')
 
 HEADERS = {
     'Authorization': f'Bearer {API_TOKEN}',
     'Content-Type': 'application/json'
 }
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG,
+# Shared upstream client: size the pool to the number of worker threads
+upstream = UpstreamClient(
+    pool_size=int(os.getenv('UPSTREAM_POOL_SIZE', '10')),
+    connect_timeout=float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5')),
+    read_timeout=float(os.getenv('UPSTREAM_READ_TIMEOUT', '60')),
+    max_retries=int(os.getenv('UPSTREAM_MAX_RETRIES', '2')),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', '5')),
+        reset_timeout=float(os.getenv('UPSTREAM_BREAKER_RESET', '30'))
+    )
+)
+
+# Admission control: cap in-flight upstream calls and share them fairly between sessions
+scheduler = UpstreamScheduler(
+    max_inflight=int(os.getenv('SCHEDULER_MAX_INFLIGHT', '8')),
+    max_queue=int(os.getenv('SCHEDULER_MAX_QUEUE', '32')),
+    queue_timeout=float(os.getenv('SCHEDULER_QUEUE_TIMEOUT', '30')),
+    rate=float(os.getenv('SESSION_RATE_LIMIT', '0.5')),
+    burst=int(os.getenv('SESSION_BURST', '5'))
+)
+
+# Upper bound on the tokens generated for a single reply
+MAX_NEW_TOKENS = int(os.getenv('MAX_NEW_TOKENS', '1024'))
+
+# The chat template has no end-of-turn token, so stop before the model writes the next user turn
+STOP_SEQUENCES = ['\nUser:']
+
+GENERATION_PARAMETERS = {
+    'max_new_tokens': MAX_NEW_TOKENS,
+    'temperature': 0.7,
+    'top_p': 0.95,
+    'return_full_text': False,  # Only the generated reply, not the prompt
+    'stop': STOP_SEQUENCES
+}
+
+# Cache of generated replies, keyed on the prompt and GENERATION_PARAMETERS
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', '600')),
+    disk_path=os.getenv('RESPONSE_CACHE_DB') or None,
+    max_disk_entries=int(os.getenv('RESPONSE_CACHE_DB_SIZE', '10000')),
+    cache_sampled=os.getenv('RESPONSE_CACHE_SAMPLED', '1') == '1'
+)
+
+# Configure logging: request threads only enqueue records, a background
+# thread writes them to the file and the console
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue,
+                                              logging.FileHandler("app.log"),
+                                              logging.StreamHandler())
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'DEBUG'),
                     format='%(asctime)s %(levelname)s %(message)s',
-                    handlers=[logging.FileHandler("app.log"),
-                              logging.StreamHandler()])
+                    handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Prompt and response payloads are logged for a sample of requests, truncated
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '500'))
+
+def log_payload(label, payload):
+    """Log a sampled, truncated prompt or response payload at debug level."""
+    if not logging.getLogger().isEnabledFor(logging.DEBUG) or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    text = str(payload)
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... [{len(text)} chars]"
+    logging.debug(f"{label}: {text}")
+
+# Chat history is stored per conversation, one row per message
+HISTORY_DB = os.getenv('HISTORY_DB', 'chat_history.db')
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))  # Messages rendered on page load
 
-HISTORY_FILE = "chat_history.json"
+history_store = HistoryStore(HISTORY_DB)
 
-def load_chat_history():
-    """Load chat history from a file."""
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r") as file:
-            return json.load(file)
-    return []
+# Prompts hold as many recent turns as fit in the token budget; the budget
+# and the reply must fit in the model's context window together
+MODEL_CONTEXT_TOKENS = int(os.getenv('MODEL_CONTEXT_TOKENS', '32768'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '4096'))
+if CONTEXT_TOKEN_BUDGET + MAX_NEW_TOKENS > MODEL_CONTEXT_TOKENS:
+    logging.warning(f"CONTEXT_TOKEN_BUDGET + MAX_NEW_TOKENS exceeds MODEL_CONTEXT_TOKENS, "
+                    f"limiting the prompt to {MODEL_CONTEXT_TOKENS - MAX_NEW_TOKENS} tokens")
+    CONTEXT_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - MAX_NEW_TOKENS
 
-def save_chat_history(history):
-    """Save chat history to a file."""
-    with open(HISTORY_FILE, "w") as file:
-        json.dump(history, file)
+context_builder = ContextBuilder(
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    count_tokens=load_token_counter(os.getenv('TOKENIZER_FILE'))
+)
+
+# Component counters served on /metrics next to the request timings
+metrics.REGISTRY.add_collector('chat_upstream', upstream.stats, UpstreamClient.STATS)
+metrics.REGISTRY.add_collector('chat_response_cache', response_cache.stats, ResponseCache.STATS)
+metrics.REGISTRY.add_collector('chat_scheduler', scheduler.stats, UpstreamScheduler.STATS)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if 'request_started' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                                        endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+def get_conversation_id():
+    """Return the conversation id of the current session, creating one if needed."""
+    if 'conversation_id' not in session:
+        session['conversation_id'] = secrets.token_hex(16)
+    return session['conversation_id']
 
 @app.route('/')
 def index():
+    conversation_id = get_conversation_id()
     if 'initialized' not in session:
         # Start with an initial message and set the initialized flag
-        session['history'] = [{'role': 'assistant', 'message': 'Hello! How can I assist you today?'}]
+        history = [{'role': 'assistant', 'message': 'Hello! How can I assist you today?'}]
         session['initialized'] = True
-        save_chat_history(session['history'])
+        history_store.append(conversation_id, 'assistant', history[0]['message'])
     else:
-        session['history'] = load_chat_history()
+        history = history_store.tail(conversation_id, HISTORY_PAGE_SIZE)
+
+    return render_template('chat.html', history=history)
 
-    return render_template('chat.html', history=session['history'])
+def too_many_requests(error):
+    """Build the 429 response for a request the scheduler did not admit."""
+    logging.warning(f"Request rejected by scheduler: {error}")
+    return jsonify({'error': 'Too many requests, please try again shortly.'}), 429, \
+        {'Retry-After': str(error.retry_after)}
 
 @app.route('/api/inference', methods=['POST'])
 def inference():
     data = request.json
     try:
-        response = requests.post(API_URL, headers=HEADERS, json=data)
+        with scheduler.slot(get_conversation_id()), metrics.time_stage('upstream_total'):
+            response = upstream.post(API_URL, headers=HEADERS, json=data)
         response.raise_for_status()  # Raise an HTTPError for bad responses
         result = response.json()
         session['ai_response'] = result  # Store the AI response in the session
         return jsonify(result)
+    except SchedulerOverloaded as e:
+        return too_many_requests(e)
+    except UpstreamUnavailable as e:
+        logging.error(f"API request skipped: {e}")
+        return jsonify({"error": "API temporarily unavailable"}), 503
     except requests.exceptions.RequestException as e:
         logging.error(f"API request failed: {e}")
         return jsonify({"error": "API request failed"}), 500
 
+@app.route('/api/upstream_stats')
+def upstream_stats():
+    """Report upstream connection reuse, retry and circuit breaker counters."""
+    return jsonify(upstream.stats())
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    """Report response cache hit and miss counters."""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/scheduler_stats')
+def scheduler_stats():
+    """Report in-flight upstream calls, queue depth and queue wait time."""
+    return jsonify(scheduler.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Expose request stage timings and component counters in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/get_response', methods=['POST'])
 def get_response():
     """Process the user input and send it to HuggingFace model."""
@@ -77,82 +224,166 @@ def get_response():
         logging.warning("Empty prompt received")
         return jsonify({'error': 'Prompt cannot be empty'}), 400
 
-    if 'history' not in session:
-        session['history'] = []
+    conversation_id = get_conversation_id()
+    message_id = history_store.append(conversation_id, 'user', user_input)
 
-    session['history'].append({'role': 'user', 'message': user_input})
+    # Construct the prompt from the most recent turns that fit in the context budget
+    prompt = context_builder.build(conversation_id, history_store)
 
-    # Limit chat history to avoid context overflow (only last 5 interactions)
-    history_for_api = session['history'][-5:]  # Only keep the last 5 exchanges
+    log_payload("Prompt sent to model", prompt)
 
-    # Construct the prompt with the entire conversation history
-    messages = [{"role": msg['role'], "content": msg['message']} for msg in history_for_api]
-    prompt = apply_chat_template(messages)
+    # Only a request that leads a new generation waits for an upstream slot or is turned away;
+    # cached replies and identical in-flight prompts are served without one
+    queue_wait = 0.0
+    admitted_at = None
+    if response_cache.will_generate(prompt, GENERATION_PARAMETERS):
+        try:
+            queue_wait = scheduler.acquire(conversation_id)
+        except SchedulerOverloaded as e:
+            history_store.remove(conversation_id, message_id)  # So a retry does not repeat the turn
+            context_builder.invalidate(conversation_id)
+            return too_many_requests(e)
+        admitted_at = time.monotonic()
 
-    logging.debug(f"Prompt sent to model: {prompt}")
+    def release_slot():
+        if admitted_at is not None:
+            scheduler.release(time.monotonic() - admitted_at)
 
-    # Get the AI response
-    ai_response = get_complete_ai_response(prompt)
+    streaming = False
+    try:
+        if request.accept_mimetypes.best == 'text/event-stream':
+            response = stream_response(prompt, conversation_id)
+            response.call_on_close(release_slot)  # Hold the slot until the stream is done
+            streaming = True
+        else:
+            # Get the AI response
+            ai_response = get_ai_response(prompt)
 
-    # Add AI response to the session history
-    session['history'].append({'role': 'assistant', 'message': ai_response})
-    save_chat_history(session['history'])  # Save the chat history to file
-    session.modified = True  # Ensure session changes are saved
+            # Add AI response to the conversation history
+            history_store.append(conversation_id, 'assistant', ai_response)
+            response = jsonify({'message': ai_response})
+    finally:
+        if not streaming:
+            release_slot()
 
-    return jsonify({'message': ai_response})
+    response.headers['X-Queue-Wait'] = f"{queue_wait:.3f}"
+    return response
 
-def apply_chat_template(messages):
-    """Apply the chat template to format the messages."""
-    intro_message = (
-        "The following is a conversation with an AI assistant.\n"
-        "The assistant is helpful, creative, clever, and concise.\n"
-    )
-    formatted_messages = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in messages])
-    return intro_message + formatted_messages + "\nAssistant:"
-
-def get_complete_ai_response(prompt):
-    """Send the prompt to HuggingFace API and return the complete response."""
-    complete_response = ""
-    while True:
-        response_part = get_ai_response(prompt + complete_response)
-        if response_part.endswith("..."):
-            complete_response += response_part[:-3]
-        else:
-            complete_response += response_part
-            break
-    return complete_response
+def sse_event(data, event=None):
+    """Format a single Server-Sent Event."""
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
 
-def get_ai_response(prompt):
-    """Send the prompt to HuggingFace API and return the response."""
-    try:
-        data = {
-            'inputs': prompt,
-            'parameters': {
-                'max_length': 1000,  # Increase max_length to accommodate longer responses
-                'temperature': 0.7,
-                'top_p': 0.95
-            }
-        }
-
-        logging.debug(f"Sending request to HuggingFace API with data: {data}")
-
-        response = requests.post(API_URL, headers=HEADERS, json=data, timeout=60)
+def stream_response(prompt, conversation_id):
+    """Stream the AI response to the client as Server-Sent Events."""
+    def generate():
+        parts = []
+        rounds = 0
+
+        def stream():
+            nonlocal rounds
+            rounds += 1
+            return stream_ai_response(prompt)
+
+        # Served from the cache, or shared with identical requests already streaming
+        try:
+            for token in response_cache.stream_or_generate(prompt, GENERATION_PARAMETERS, stream):
+                parts.append(token)
+                yield sse_event({'token': token})
+        except requests.exceptions.Timeout:
+            logging.error("Request to HuggingFace API timed out.")
+            yield sse_event({'error': "Error: Request timed out."}, event='error')
+            return
+        except Exception as e:
+            logging.error(f"Streaming from HuggingFace API failed: {e}")
+            yield sse_event({'error': f"Error: {e}"}, event='error')
+            return
+        finally:
+            metrics.GENERATION_ROUNDS.observe(rounds)
+
+        ai_response = "".join(parts).strip() or 'No response generated.'
+        history_store.append(conversation_id, 'assistant', ai_response)
+        yield sse_event({'message': ai_response}, event='done')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def stream_ai_response(prompt):
+    """Send the prompt to HuggingFace API and yield the response tokens as they arrive."""
+    data = {
+        'inputs': prompt,
+        'parameters': GENERATION_PARAMETERS,
+        'stream': True
+    }
+
+    log_payload("Sending streaming request to HuggingFace API with data", data)
+
+    # Time spent waiting for the client to take each token is not upstream time
+    with metrics.StageTimer('upstream_total') as timer, \
+            upstream.post(API_URL, headers=HEADERS, json=data, stream=True) as response:
         response.raise_for_status()
+        pending = ''
+        for line in response.iter_lines(decode_unicode=True):
+            token = parse_stream_line(line)
+            if token:
+                text, pending, stopped = cut_at_stop(pending + token)
+                if text:
+                    with timer.paused():
+                        yield text
+                if stopped:
+                    return
+        if pending:
+            with timer.paused():
+                yield pending
 
-        response_json = response.json()
-        logging.debug(f"Received response from HuggingFace API: {response_json}")
-
-        if isinstance(response_json, list) and len(response_json) > 0:
-            generated_text = response_json[0].get('generated_text', 'No response generated.')
-            logging.debug(f"Generated text before processing: {generated_text}")
-            # Remove the user's message from the AI response if it is included
-            if "Assistant:" in generated_text:
-                generated_text = generated_text.split("Assistant:")[-1].strip()
-            logging.debug(f"Generated text after processing: {generated_text}")
-            return generated_text
-        else:
+def cut_at_stop(text):
+    """Split streamed text at the first stop sequence, in case the upstream ignores `stop`.
+
+    Returns the text to emit, the tail held back because it may be the start
+    of a stop sequence split across tokens, and whether a stop sequence was found.
+    """
+    cuts = [text.find(stop) for stop in STOP_SEQUENCES if stop in text]
+    if cuts:
+        return text[:min(cuts)], '', True
+    held = max((size for stop in STOP_SEQUENCES for size in range(1, len(stop)) if text.endswith(stop[:size])),
+               default=0)
+    return text[:len(text) - held], text[len(text) - held:], False
+
+def parse_stream_line(line):
+    """Return the token text carried by one line of the HuggingFace event stream, if any."""
+    if not line or not line.startswith('data:'):
+        return None
+    event = json.loads(line[len('data:'):])
+    if 'error' in event:
+        raise RuntimeError(event['error'])
+    token = event.get('token') or {}
+    if token.get('special'):
+        return None
+    return token.get('text')
+
+def get_ai_response(prompt):
+    """Send the prompt to HuggingFace API and return the complete response.
+
+    The reply is generated in a single streamed request bounded by
+    MAX_NEW_TOKENS rather than by re-sending the prompt until the text
+    stops being truncated. Identical prompts are served from the response
+    cache, and concurrent identical requests share one upstream call.
+    """
+    rounds = 0
+
+    def generate():
+        nonlocal rounds
+        rounds += 1
+        return "".join(stream_ai_response(prompt)).strip()
+
+    try:
+        generated_text = response_cache.get_or_generate(prompt, GENERATION_PARAMETERS, generate)
+        log_payload("Generated text", generated_text)
+        if not generated_text:
             logging.warning("No valid response received from HuggingFace API.")
             return "No valid response received."
+        return generated_text
     except requests.exceptions.Timeout:
         logging.error("Request to HuggingFace API timed out.")
         return "Error: Request timed out."
@@ -162,22 +393,38 @@ def get_ai_response(prompt):
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         return f"Error: {e}"
+    finally:
+        metrics.GENERATION_ROUNDS.observe(rounds)
 
 @app.route('/clear', methods=['POST'])
 def clear_chat():
     """Clear chat history."""
-    session['history'] = []
-    save_chat_history([])  # Clear the chat history file
-    session.modified = True  # Ensure session changes are saved
+    conversation_id = get_conversation_id()
+    history_store.clear(conversation_id)
+    context_builder.invalidate(conversation_id)
     return jsonify({'status': 'success'})
 
 @app.route('/save_history', methods=['POST'])
 def save_history():
-    """Save the chat history to a file."""
-    data = request.json
-    history = data.get('history', [])
-    save_chat_history(history)
+    """Replace the stored chat history with the one sent by the client."""
+    data = request.get_json(silent=True)
+    history = data.get('history', []) if isinstance(data, dict) else None
+    if not isinstance(history, list) or not all(
+            isinstance(msg, dict) and isinstance(msg.get('role', 'user'), str)
+            and isinstance(msg.get('message', ''), str) for msg in history):
+        logging.warning("Malformed history received")
+        return jsonify({'error': 'History must be a list of {role, message} objects'}), 400
+    conversation_id = get_conversation_id()
+    if history_store.import_history(conversation_id, history):
+        context_builder.invalidate(conversation_id)
     return jsonify({'status': 'success'})
 
+@app.cli.command('compact-history')
+@click.option('--keep', type=int, default=None, help='Messages to keep per conversation.')
+def compact_history(keep):
+    """Trim old messages and reclaim space in the chat history database."""
+    deleted = history_store.compact(keep)
+    click.echo(f"Deleted {deleted} messages from {HISTORY_DB}")
+
 if __name__ == '__main__':
     app.run(debug=True)
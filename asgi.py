@@ -0,0 +1,370 @@
+"""Async serving mode: run with `uvicorn asgi:application`.
+
+/get_response and /api/inference are served on the event loop with a
+non-blocking upstream client, so a waiting chat costs a coroutine rather
+than a worker thread. History, session and cache I/O run in worker
+threads off the loop. All other routes are served by the Flask app in
+worker threads.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import secrets
+import sys
+import time
+from urllib.parse import parse_qs
+
+import httpx
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_cookie
+from werkzeug.wrappers import Response
+
+import metrics
+from app import (API_URL, GENERATION_PARAMETERS, HEADERS, app, context_builder, cut_at_stop, history_store,
+                 log_payload, parse_stream_line, response_cache, scheduler, sse_event, upstream)
+from scheduler import SchedulerOverloaded
+from upstream import AsyncUpstreamClient, UpstreamUnavailable
+
+
+class AsyncChatApp:
+    """ASGI application for the chat routes that wait on the upstream model."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.upstream = None
+        self.routes = {
+            ('POST', '/get_response'): self.get_response,
+            ('POST', '/api/inference'): self.inference
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        handler = self.routes.get((scope.get('method'), scope.get('path')))
+        if scope['type'] == 'http' and handler is not None:
+            started = time.perf_counter()
+
+            async def timed_send(message):
+                if message['type'] == 'http.response.start':
+                    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                                    endpoint=handler.__name__, status=message['status'])
+                await send(message)
+
+            await handler(scope, receive, timed_send)
+        else:
+            await self.call_flask(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.upstream is not None:
+                    await self.upstream.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def client(self):
+        """Return the async upstream client, creating it inside the running event loop."""
+        if self.upstream is None:
+            self.upstream = AsyncUpstreamClient(
+                pool_size=int(os.getenv('ASYNC_UPSTREAM_POOL_SIZE', '100')),
+                connect_timeout=float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5')),
+                read_timeout=float(os.getenv('UPSTREAM_READ_TIMEOUT', '60')),
+                max_retries=int(os.getenv('UPSTREAM_MAX_RETRIES', '2')),
+                breaker=upstream.breaker  # Share the breaker with the sync client
+            )
+            metrics.REGISTRY.add_collector('chat_async_upstream', self.upstream.stats, AsyncUpstreamClient.STATS)
+        return self.upstream
+
+    async def call_flask(self, scope, receive, send):
+        """Serve a request with the Flask app in a worker thread.
+
+        The routes left to Flask return small buffered responses, so the
+        whole response body is collected before it is sent.
+        """
+        environ = wsgi_environ(scope, await self.read_body(receive))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        def run():
+            iterable = self.flask_app(environ, start_response)
+            try:
+                return b''.join(iterable)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        body = await asyncio.to_thread(run)
+        await self.start_response(send, response['status'], response['headers'])
+        await send({'type': 'http.response.body', 'body': body})
+
+    # Request and session helpers
+
+    @staticmethod
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    def header(scope, name):
+        """Return a request header, joining repeated ones as wsgi_environ() does."""
+        values = [value.decode('latin-1') for key, value in scope['headers']
+                  if key.decode('latin-1').lower() == name]
+        return ('; ' if name == 'cookie' else ',').join(values)
+
+    def open_session(self, scope):
+        """Load the server-side session named by the request cookie."""
+        cookies = parse_cookie(self.header(scope, 'cookie'))
+        interface = self.flask_app.session_interface
+        return interface.load(self.flask_app, cookies.get(interface.get_cookie_name(self.flask_app)))
+
+    def save_session(self, session):
+        """Persist the session and return the Set-Cookie headers for it."""
+        response = Response()
+        self.flask_app.session_interface.save_session(self.flask_app, session, response)
+        return [('Set-Cookie', cookie) for cookie in response.headers.getlist('Set-Cookie')]
+
+    def conversation_id(self, session):
+        """Return the conversation id of the session, creating one if needed."""
+        if 'conversation_id' not in session:
+            session['conversation_id'] = secrets.token_hex(16)
+        return session['conversation_id']
+
+    @staticmethod
+    async def start_response(send, status, headers):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers]})
+
+    async def send_json(self, send, data, status=200, headers=()):
+        await self.start_response(send, status, [('Content-Type', 'application/json'), *headers])
+        await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+    async def too_many_requests(self, send, error, headers=()):
+        """Send the 429 response for a request the scheduler did not admit."""
+        logging.warning(f"Request rejected by scheduler: {error}")
+        await self.send_json(send, {'error': 'Too many requests, please try again shortly.'}, status=429,
+                             headers=[('Retry-After', str(error.retry_after)), *headers])
+
+    # Upstream calls
+
+    async def stream_ai_response(self, prompt):
+        """Send the prompt to HuggingFace API and yield the response tokens as they arrive."""
+        data = {
+            'inputs': prompt,
+            'parameters': GENERATION_PARAMETERS,
+            'stream': True
+        }
+
+        log_payload("Sending streaming request to HuggingFace API with data", data)
+
+        # Time spent waiting for the consumer to take each token is not upstream time
+        with metrics.StageTimer('upstream_total') as timer:
+            async with self.client().stream(API_URL, headers=HEADERS, json=data) as response:
+                response.raise_for_status()
+                pending = ''
+                async for line in response.aiter_lines():
+                    token = parse_stream_line(line)
+                    if token:
+                        text, pending, stopped = cut_at_stop(pending + token)
+                        if text:
+                            with timer.paused():
+                                yield text
+                        if stopped:
+                            return
+                if pending:
+                    with timer.paused():
+                        yield pending
+
+    async def reply_tokens(self, prompt):
+        """Yield the reply tokens from the cache, an identical in-flight generation or the upstream."""
+        rounds = 0
+
+        def stream():
+            nonlocal rounds
+            rounds += 1
+            return self.stream_ai_response(prompt)
+
+        try:
+            async for token in response_cache.stream_or_generate_async(prompt, GENERATION_PARAMETERS, stream):
+                yield token
+        finally:
+            metrics.GENERATION_ROUNDS.observe(rounds)
+
+    async def generate(self, prompt):
+        """Return the complete response, sharing one upstream call between identical prompts."""
+        return "".join([token async for token in self.reply_tokens(prompt)]).strip()
+
+    async def get_ai_response(self, prompt):
+        """Async counterpart of app.get_ai_response."""
+        try:
+            generated_text = await self.generate(prompt)
+            log_payload("Generated text", generated_text)
+            if not generated_text:
+                logging.warning("No valid response received from HuggingFace API.")
+                return "No valid response received."
+            return generated_text
+        except httpx.TimeoutException:
+            logging.error("Request to HuggingFace API timed out.")
+            return "Error: Request timed out."
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            logging.error(f"Request to HuggingFace API failed: {e}")
+            return f"Error: {e}"
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            return f"Error: {e}"
+
+    # Routes
+
+    async def get_response(self, scope, receive, send):
+        """Process the user input and send it to HuggingFace model."""
+        form = parse_qs((await self.read_body(receive)).decode())
+        user_input = form.get('prompt', [''])[0].strip()
+        if not user_input:
+            logging.warning("Empty prompt received")
+            await self.send_json(send, {'error': 'Prompt cannot be empty'}, status=400)
+            return
+
+        session = await asyncio.to_thread(self.open_session, scope)
+        conversation_id = self.conversation_id(session)
+        headers = await asyncio.to_thread(self.save_session, session)
+
+        message_id = await asyncio.to_thread(history_store.append, conversation_id, 'user', user_input)
+        prompt = await asyncio.to_thread(context_builder.build, conversation_id, history_store)
+
+        log_payload("Prompt sent to model", prompt)
+
+        # Only a request that leads a new generation waits for an upstream slot or is turned away
+        queue_wait = 0.0
+        admitted_at = None
+        if await asyncio.to_thread(response_cache.will_generate, prompt, GENERATION_PARAMETERS):
+            try:
+                queue_wait = await scheduler.acquire_async(conversation_id)
+            except SchedulerOverloaded as e:
+                await asyncio.to_thread(history_store.remove, conversation_id, message_id)
+                context_builder.invalidate(conversation_id)
+                await self.too_many_requests(send, e, headers)
+                return
+            admitted_at = time.monotonic()
+        headers.append(('X-Queue-Wait', f"{queue_wait:.3f}"))
+
+        try:
+            if parse_accept_header(self.header(scope, 'accept'), MIMEAccept).best == 'text/event-stream':
+                await self.stream_response(send, prompt, conversation_id, headers)
+                return
+
+            ai_response = await self.get_ai_response(prompt)
+            await asyncio.to_thread(history_store.append, conversation_id, 'assistant', ai_response)
+            await self.send_json(send, {'message': ai_response}, headers=headers)
+        finally:
+            if admitted_at is not None:
+                scheduler.release(time.monotonic() - admitted_at)
+
+    async def stream_response(self, send, prompt, conversation_id, headers):
+        """Stream the AI response to the client as Server-Sent Events."""
+        await self.start_response(send, 200, [('Content-Type', 'text/event-stream; charset=utf-8'),
+                                              ('Cache-Control', 'no-cache'),
+                                              ('X-Accel-Buffering', 'no'),
+                                              *headers])
+
+        async def send_event(data, event=None, more_body=True):
+            await send({'type': 'http.response.body', 'body': sse_event(data, event).encode(),
+                        'more_body': more_body})
+
+        parts = []
+        try:
+            async for token in self.reply_tokens(prompt):
+                parts.append(token)
+                await send_event({'token': token})
+        except httpx.TimeoutException:
+            logging.error("Request to HuggingFace API timed out.")
+            await send_event({'error': "Error: Request timed out."}, event='error', more_body=False)
+            return
+        except Exception as e:
+            logging.error(f"Streaming from HuggingFace API failed: {e}")
+            await send_event({'error': f"Error: {e}"}, event='error', more_body=False)
+            return
+
+        ai_response = "".join(parts).strip() or 'No response generated.'
+        await asyncio.to_thread(history_store.append, conversation_id, 'assistant', ai_response)
+        await send_event({'message': ai_response}, event='done', more_body=False)
+
+    async def inference(self, scope, receive, send):
+        # Save the session up front so every response carries its cookie
+        session = await asyncio.to_thread(self.open_session, scope)
+        conversation_id = self.conversation_id(session)
+        headers = await asyncio.to_thread(self.save_session, session)
+        try:
+            data = json.loads(await self.read_body(receive))
+        except ValueError:
+            await self.send_json(send, {"error": "Invalid JSON body"}, status=400, headers=headers)
+            return
+        try:
+            async with scheduler.slot_async(conversation_id):
+                with metrics.time_stage('upstream_total'):
+                    response = await self.client().post(API_URL, headers=HEADERS, json=data)
+            response.raise_for_status()  # Raise an HTTPError for bad responses
+            result = response.json()
+        except SchedulerOverloaded as e:
+            await self.too_many_requests(send, e, headers)
+            return
+        except UpstreamUnavailable as e:
+            logging.error(f"API request skipped: {e}")
+            await self.send_json(send, {"error": "API temporarily unavailable"}, status=503, headers=headers)
+            return
+        except (httpx.HTTPError, ValueError) as e:
+            logging.error(f"API request failed: {e}")
+            await self.send_json(send, {"error": "API request failed"}, status=500, headers=headers)
+            return
+
+        session['ai_response'] = result  # Store the AI response in the session
+        await asyncio.to_thread(self.save_session, session)
+        await self.send_json(send, result, headers=headers)
+
+
+def wsgi_environ(scope, body):
+    """Build the WSGI environ for an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            # Repeated headers are comma-joined, except cookies which use "; "
+            value = f"{environ[name]}{'; ' if name == 'HTTP_COOKIE' else ','}{value}"
+        environ[name] = value
+    return environ
+
+
+application = AsyncChatApp(app)
@@ -0,0 +1,98 @@
+"""Load generator driving the chat app with many concurrent sessions."""
+import random
+import threading
+import time
+
+import requests
+
+# Relative weight of each action a simulated user takes after a turn
+DEFAULT_MIX = {'get_response': 0.75, 'index': 0.1, 'inference': 0.1, 'clear': 0.05}
+
+
+class Sample:
+    """Timing of a single request."""
+
+    __slots__ = ('endpoint', 'status', 'latency', 'ttfb', 'bytes')
+
+    def __init__(self, endpoint, status, latency, ttfb, size):
+        self.endpoint = endpoint
+        self.status = status
+        self.latency = latency
+        self.ttfb = ttfb
+        self.bytes = size
+
+
+class VirtualUser:
+    """One chat session: seeds a history, then sends a mix of requests."""
+
+    def __init__(self, base_url, history_length, stream, mix, think_time, rng):
+        self.base_url = base_url
+        self.history_length = history_length
+        self.stream = stream
+        self.mix = mix
+        self.think_time = think_time
+        self.rng = rng
+        self.http = requests.Session()
+        self.samples = []
+
+    def request(self, endpoint, method, path, **kwargs):
+        started = time.perf_counter()
+        ttfb = None
+        size = 0
+        status = 0
+        try:
+            with self.http.request(method, self.base_url + path, stream=True, timeout=120, **kwargs) as response:
+                status = response.status_code
+                for chunk in response.iter_content(chunk_size=None):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    size += len(chunk)
+        except requests.exceptions.RequestException:
+            pass
+        latency = time.perf_counter() - started
+        self.samples.append(Sample(endpoint, status, latency, ttfb if ttfb is not None else latency, size))
+
+    def seed_history(self):
+        """Give the conversation `history_length` prior messages."""
+        history = []
+        for i in range(self.history_length):
+            role = 'user' if i % 2 == 0 else 'assistant'
+            history.append({'role': role, 'message': f"{role} message {i} " * self.rng.randint(1, 20)})
+        self.http.post(self.base_url + '/save_history', json={'history': history}, timeout=60)
+
+    def run(self, deadline):
+        self.request('index', 'GET', '/')
+        self.seed_history()
+        actions = list(self.mix)
+        weights = [self.mix[action] for action in actions]
+        while time.monotonic() < deadline:
+            action = self.rng.choices(actions, weights)[0]
+            if action == 'get_response':
+                headers = {'Accept': 'text/event-stream'} if self.stream else {}
+                prompt = f"Question {self.rng.randint(0, 50)}: tell me about item {self.rng.randint(0, 1000)}"
+                self.request(action, 'POST', '/get_response', data={'prompt': prompt}, headers=headers)
+            elif action == 'index':
+                self.request(action, 'GET', '/')
+            elif action == 'inference':
+                self.request(action, 'POST', '/api/inference',
+                             json={'inputs': 'Hello', 'parameters': {'max_new_tokens': 20}})
+            elif action == 'clear':
+                self.request(action, 'POST', '/clear')
+                self.seed_history()
+            if self.think_time:
+                time.sleep(self.rng.uniform(0, self.think_time))
+
+
+def run_load(base_url, sessions=20, duration=30.0, history_lengths=(0, 10, 50), stream=False,
+             mix=None, think_time=0.0, seed=0):
+    """Run `sessions` concurrent virtual users for `duration` seconds and return all samples."""
+    deadline = time.monotonic() + duration
+    users = [VirtualUser(base_url, history_lengths[i % len(history_lengths)], stream, mix or DEFAULT_MIX,
+                         think_time, random.Random(seed + i))
+             for i in range(sessions)]
+    threads = [threading.Thread(target=user.run, args=(deadline,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [sample for user in users for sample in user.samples]
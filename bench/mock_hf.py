@@ -0,0 +1,175 @@
+"""Local stand-in for the HuggingFace Inference API, for benchmarks.
+
+    python bench/mock_hf.py --port 8081 --latency 0.3 --token-rate 50
+
+Point the app at it with HUGGINGFACE_API_URL=http://127.0.0.1:8081/model.
+Both plain JSON and streamed (`"stream": true`) generations are served.
+GET /__stats returns request and byte counters, POST /__reset clears them.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "the quick brown fox jumps over a lazy dog while the assistant explains it clearly".split()
+
+
+class MockState:
+    """Configuration and counters shared by all request handlers.
+
+    `script` replaces the random words with fixed token texts, and
+    `stream_error` ends every stream with a text-generation-inference
+    error event carrying that message.
+    """
+
+    def __init__(self, latency=0.2, token_rate=50.0, tokens=60, error_rate=0.0,
+                 throttle_rate=0.0, truncate_rate=0.0, script=None, stream_error=None):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.truncate_rate = truncate_rate
+        self.script = script
+        self.stream_error = stream_error
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {'requests': 0, 'streamed': 0, 'bytes_received': 0, 'bytes_sent': 0,
+                             'errors': 0, 'throttled': 0, 'truncated': 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # Set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=()):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count('bytes_sent', len(body))
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            self.send_json(200, self.state.stats())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/__reset':
+            self.state.reset()
+            self.send_json(200, {'status': 'success'})
+            return
+
+        state = self.state
+        state.count('requests')
+        state.count('bytes_received', len(body) + sum(len(k) + len(v) + 4 for k, v in self.headers.items()))
+        data = json.loads(body or b'{}')
+
+        time.sleep(state.latency)
+        roll = random.random()
+        if roll < state.throttle_rate:
+            state.count('throttled')
+            self.send_json(429, {'error': 'Rate limit reached'}, headers=[('Retry-After', '1')])
+            return
+        if roll < state.throttle_rate + state.error_rate:
+            state.count('errors')
+            self.send_json(503, {'error': 'Model is overloaded'})
+            return
+
+        parameters = data.get('parameters') or {}
+        count = min(state.tokens, parameters.get('max_new_tokens', state.tokens))
+        if state.script is not None:
+            tokens = list(state.script)
+            count = len(tokens)
+        else:
+            tokens = [random.choice(WORDS) + ' ' for _ in range(count)]
+        if random.random() < state.truncate_rate:
+            state.count('truncated')
+            tokens.append('...')
+
+        if data.get('stream'):
+            state.count('streamed')
+            self.stream(tokens)
+        else:
+            text = ''.join(tokens)
+            if parameters.get('return_full_text', True):
+                text = data.get('inputs', '') + text
+            time.sleep(count / state.token_rate)
+            self.send_json(200, [{'generated_text': text}])
+
+    def stream(self, tokens):
+        """Send the tokens as a text-generation-inference event stream."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, text in enumerate(tokens):
+            time.sleep(1 / self.state.token_rate)
+            event = {'token': {'id': i, 'text': text, 'special': False}, 'generated_text': None}
+            if i == len(tokens) - 1:
+                event['generated_text'] = ''.join(tokens)
+            self.write_chunk(f"data:{json.dumps(event)}\n\n".encode())
+        if self.state.stream_error:
+            event = {'error': self.state.stream_error, 'error_type': 'generation'}
+            self.write_chunk(f"data:{json.dumps(event)}\n\n".encode())
+        self.write_chunk(b'')
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+        self.state.count('bytes_sent', len(data))
+
+
+def make_server(port, state):
+    """Return an HTTP server for the stand-in; port 0 picks a free port."""
+    handler = type('Handler', (MockHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(port, state):
+    """Serve the stand-in until interrupted."""
+    make_server(port, state).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first byte.')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='Tokens generated per second.')
+    parser.add_argument('--tokens', type=int, default=60, help='Tokens per reply.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of 503 responses.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of 429 responses.')
+    parser.add_argument('--truncate-rate', type=float, default=0.0,
+                        help='Fraction of replies that end in "...".')
+    args = parser.parse_args()
+    serve(args.port, MockState(latency=args.latency, token_rate=args.token_rate, tokens=args.tokens,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               truncate_rate=args.truncate_rate))
+
+
+if __name__ == '__main__':
+    main()
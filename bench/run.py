@@ -0,0 +1,334 @@
+"""Run reproducible load scenarios against the app and a local HuggingFace stand-in.
+
+    python bench/run.py                          # every scenario
+    python bench/run.py -s baseline -s streaming --duration 10
+    python bench/run.py --compare bench/results/a.json bench/results/b.json
+
+Each scenario starts bench/mock_hf.py and the app (sync `flask run` or the
+async `uvicorn asgi:application`) in a fresh temporary directory, drives
+them with bench/loadgen.py and writes its results to bench/results/.
+"""
+import argparse
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from loadgen import run_load  # noqa: E402
+
+# App settings for every scenario: admission limits are raised so they
+# measure the app rather than the scheduler, unless a scenario overrides them
+BASE_ENV = {
+    'SECRET_KEY': 'bench',
+    'HUGGINGFACE_API_TOKEN': 'bench',
+    'SCHEDULER_MAX_INFLIGHT': '64',
+    'SCHEDULER_MAX_QUEUE': '256',
+    'SESSION_RATE_LIMIT': '100',
+    'SESSION_BURST': '100',
+    'RESPONSE_CACHE_SIZE': '0',
+    'LOG_LEVEL': 'WARNING'
+}
+
+SCENARIOS = {
+    'baseline': {
+        'description': 'JSON replies, mixed history lengths',
+        'load': {'sessions': 20, 'history_lengths': [0, 10, 50]},
+        'mock': {}
+    },
+    'streaming': {
+        'description': 'Server-Sent Events replies, mixed history lengths',
+        'load': {'sessions': 20, 'history_lengths': [0, 10, 50], 'stream': True},
+        'mock': {}
+    },
+    'long_history': {
+        'description': 'Long conversations, to expose per-turn history and prompt costs',
+        'load': {'sessions': 20, 'history_lengths': [100, 200, 400]},
+        'mock': {}
+    },
+    'truncated': {
+        'description': 'A third of replies end in "..."',
+        'load': {'sessions': 20, 'history_lengths': [0, 10, 50]},
+        'mock': {'truncate_rate': 0.3}
+    },
+    'degraded_upstream': {
+        'description': 'Upstream answers 10% 429 and 5% 503',
+        'load': {'sessions': 20, 'history_lengths': [0, 10, 50]},
+        'mock': {'throttle_rate': 0.1, 'error_rate': 0.05}
+    },
+    'overload': {
+        'description': 'Default admission limits under a burst of sessions',
+        'load': {'sessions': 100, 'history_lengths': [0, 10]},
+        'mock': {'latency': 1.0},
+        'env': {'SCHEDULER_MAX_INFLIGHT': '8', 'SCHEDULER_MAX_QUEUE': '32',
+                'SESSION_RATE_LIMIT': '0.5', 'SESSION_BURST': '5'}
+    },
+    'async_many_sessions': {
+        'description': 'Async serving mode holding many slow concurrent chats',
+        'serve': 'async',
+        'load': {'sessions': 200, 'history_lengths': [0, 10], 'stream': True, 'think_time': 1.0},
+        'mock': {'latency': 1.0}
+    }
+}
+
+MOCK_DEFAULTS = {'latency': 0.2, 'token_rate': 50.0, 'tokens': 60, 'error_rate': 0.0,
+                 'throttle_rate': 0.0, 'truncate_rate': 0.0}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def process_io(pid):
+    """Return the bytes a process has read from and written to storage (Linux only).
+
+    This counts every file the app touches: the log, the session database
+    and the history database.
+    """
+    try:
+        with open(f'/proc/{pid}/io') as file:
+            fields = dict(line.split(': ') for line in file.read().splitlines())
+        return {'read_bytes': int(fields['read_bytes']), 'write_bytes': int(fields['write_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def history_size(workdir):
+    """Total size of the history database files, including its write-ahead log."""
+    return sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)
+               if name.startswith('chat_history'))
+
+
+def history_save_stage(base_url):
+    """Return the count and total seconds of the app's history_save stage, read from /metrics."""
+    try:
+        text = requests.get(base_url + '/metrics', timeout=10).text
+    except requests.RequestException:
+        return None
+    stage = {}
+    for field in ('count', 'sum'):
+        prefix = f'chat_stage_seconds_{field}{{stage="history_save"}} '
+        for line in text.splitlines():
+            if line.startswith(prefix):
+                stage[field] = float(line[len(prefix):])
+    return stage if len(stage) == 2 else None
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(samples, duration):
+    endpoints = {}
+    for name in sorted({sample.endpoint for sample in samples}):
+        group = [sample for sample in samples if sample.endpoint == name]
+        latencies = [sample.latency for sample in group]
+        ttfbs = [sample.ttfb for sample in group]
+        statuses = {}
+        for sample in group:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+        endpoints[name] = {
+            'requests': len(group),
+            'requests_per_second': len(group) / duration,
+            'statuses': statuses,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'ttfb_p50': percentile(ttfbs, 0.50),
+            'ttfb_p95': percentile(ttfbs, 0.95),
+            'bytes_received': sum(sample.bytes for sample in group)
+        }
+    return endpoints
+
+
+def run_scenario(name, scenario, duration, serve=None):
+    """Run one scenario and return its results."""
+    serve = serve or scenario.get('serve', 'sync')
+    mock_config = {**MOCK_DEFAULTS, **scenario.get('mock', {})}
+    mock_port, app_port = free_port(), free_port()
+    base_url = f'http://127.0.0.1:{app_port}'
+
+    with tempfile.TemporaryDirectory() as workdir:
+        mock_args = [sys.executable, os.path.join(BENCH_DIR, 'mock_hf.py'), '--port', str(mock_port)]
+        for key, value in mock_config.items():
+            mock_args += ['--' + key.replace('_', '-'), str(value)]
+
+        env = {**os.environ, **BASE_ENV, **scenario.get('env', {}),
+               'HUGGINGFACE_API_URL': f'http://127.0.0.1:{mock_port}/model'}
+        if serve == 'async':
+            app_args = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--app-dir', REPO_DIR,
+                        '--port', str(app_port), '--log-level', 'warning']
+        else:
+            app_args = [sys.executable, '-m', 'flask', '--app', os.path.join(REPO_DIR, 'app.py'),
+                        'run', '--port', str(app_port), '--with-threads']
+
+        mock = subprocess.Popen(mock_args, cwd=workdir)
+        app = subprocess.Popen(app_args, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(f'http://127.0.0.1:{mock_port}/__stats')
+            wait_until_up(base_url + '/')
+            requests.post(f'http://127.0.0.1:{mock_port}/__reset')
+            io_before = process_io(app.pid)
+            history_before = history_size(workdir)
+            saves_before = history_save_stage(base_url)
+
+            started = time.monotonic()
+            samples = run_load(base_url, duration=duration, **scenario['load'])
+            elapsed = time.monotonic() - started
+
+            io_after = process_io(app.pid)
+            upstream = requests.get(f'http://127.0.0.1:{mock_port}/__stats').json()
+            history_bytes = history_size(workdir)
+            saves_after = history_save_stage(base_url)
+        finally:
+            app.terminate()
+            mock.terminate()
+            app.wait()
+            mock.wait()
+
+    turns = sum(1 for sample in samples if sample.endpoint == 'get_response')
+    return {
+        'scenario': name,
+        'description': scenario['description'],
+        'serve': serve,
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'duration': elapsed,
+        'load': scenario['load'],
+        'mock': mock_config,
+        'env': scenario.get('env', {}),
+        'requests': len(samples),
+        'requests_per_second': len(samples) / elapsed,
+        'endpoints': summarize(samples, elapsed),
+        'upstream': {**upstream,
+                     'bytes_sent_per_turn': upstream['bytes_received'] / turns if turns else None},
+        'history_io': {
+            'database_bytes': history_bytes,
+            'database_growth_bytes': history_bytes - history_before,
+            'saves': int(saves_after['count'] - saves_before['count']) if saves_before and saves_after else None,
+            'save_seconds': saves_after['sum'] - saves_before['sum'] if saves_before and saves_after else None
+        },
+        'process_io': {
+            'read_bytes': io_after['read_bytes'] - io_before['read_bytes'] if io_before and io_after else None,
+            'write_bytes': io_after['write_bytes'] - io_before['write_bytes'] if io_before and io_after else None
+        }
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_seconds(value):
+    return f"{value * 1000:8.1f}ms" if value is not None else '       n/a'
+
+
+def report(results):
+    print(f"\n{results['scenario']} ({results['serve']}): {results['description']}")
+    print(f"  {results['requests']} requests in {results['duration']:.1f}s, "
+          f"{results['requests_per_second']:.1f} req/s")
+    for name, endpoint in results['endpoints'].items():
+        print(f"  {name:<14} n={endpoint['requests']:<6} p50={format_seconds(endpoint['p50'])} "
+              f"p95={format_seconds(endpoint['p95'])} p99={format_seconds(endpoint['p99'])} "
+              f"statuses={endpoint['statuses']}")
+    upstream = results['upstream']
+    print(f"  upstream: {upstream['requests']} calls, {upstream['bytes_received']} bytes sent by the app")
+    history = results['history_io']
+    save_seconds = f"{history['save_seconds']:.3f}s" if history['save_seconds'] is not None else 'n/a'
+    print(f"  history: database {history['database_bytes']} bytes ({history['database_growth_bytes']:+d}), "
+          f"{history['saves']} saves taking {save_seconds}")
+    process = results['process_io']
+    print(f"  app process I/O (log, sessions and history): read {process['read_bytes']} / "
+          f"wrote {process['write_bytes']} bytes")
+
+
+def compare(before_path, after_path):
+    """Print the change in throughput and latency between two result files."""
+    with open(before_path) as file:
+        before = json.load(file)
+    with open(after_path) as file:
+        after = json.load(file)
+
+    def change(old, new):
+        if not old or new is None:
+            return '     n/a'
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"{before['scenario']}: {before.get('commit')} -> {after.get('commit')}")
+    print(f"  req/s {before['requests_per_second']:.1f} -> {after['requests_per_second']:.1f} "
+          f"({change(before['requests_per_second'], after['requests_per_second']).strip()})")
+    for name, new in after['endpoints'].items():
+        old = before['endpoints'].get(name, {})
+        print(f"  {name:<14} " + ' '.join(
+            f"{key}={change(old.get(key), new[key])}" for key in ('p50', 'p95', 'p99')))
+    print(f"  upstream bytes/turn {change(before['upstream']['bytes_sent_per_turn'], after['upstream']['bytes_sent_per_turn'])}")
+
+    def per_save(history, key):
+        return history[key] / history['saves'] if history.get('saves') and history.get(key) is not None else None
+
+    old, new = before['history_io'], after['history_io']
+    growth = 'database_growth_bytes'
+    print(f"  history bytes/save  {change(per_save(old, growth), per_save(new, growth))}")
+    print(f"  history time/save   {change(per_save(old, 'save_seconds'), per_save(new, 'save_seconds'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run load scenarios against the chat app.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, default: all).')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds of load per scenario.')
+    parser.add_argument('--serve', choices=['sync', 'async'], help='Override the serving mode.')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results'),
+                        help='Directory for result files.')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two result files instead of running.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    for name in args.scenario or SCENARIOS:
+        results = run_scenario(name, SCENARIOS[name], args.duration, args.serve)
+        report(results)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(args.output, f"{stamp}-{name}-{results['serve']}.json")
+        with open(path, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"  saved {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import importlib
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+
+from mock_hf import MockState, make_server  # noqa: E402
+
+
+@pytest.fixture
+def mock_upstream():
+    """Run bench/mock_hf.py in a thread; yields its model URL and MockState."""
+    state = MockState(latency=0.0, token_rate=1000.0, tokens=5)
+    server = make_server(0, state)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/model', state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='session')
+def chat_app(tmp_path_factory):
+    """The Flask app, importing app.py with its databases and log in a temporary directory.
+
+    The environment and working directory are restored once app.py has
+    read its settings, including what load_dotenv() added.
+    """
+    workdir = tmp_path_factory.mktemp('app')
+    environ = dict(os.environ)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.update({'SECRET_KEY': 'test', 'HISTORY_DB': str(workdir / 'history.db'),
+                       'SESSION_DB': str(workdir / 'sessions.db'), 'LOG_LEVEL': 'WARNING'})
+    try:
+        module = importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+    return module
@@ -0,0 +1,133 @@
+"""Token-budgeted prompt construction from the stored conversation history."""
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from metrics import time_stage
+
+INTRO_MESSAGE = (
+    "The following is a conversation with an AI assistant.\n"
+    "The assistant is helpful, creative, clever, and concise.\n"
+)
+PROMPT_SUFFIX = "\nAssistant:"
+
+
+def format_message(role, message):
+    """Format a single message as a line of the chat template."""
+    return f"{role.capitalize()}: {message}"
+
+
+def approximate_tokens(text):
+    """Estimate the number of tokens in text at about four characters per token."""
+    return len(text) // 4 + 1
+
+
+def load_token_counter(tokenizer_file=None):
+    """Return a token counting function, using a local tokenizer file when available."""
+    if not tokenizer_file:
+        return approximate_tokens
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logging.warning("tokenizers is not installed, approximating token counts.")
+        return approximate_tokens
+    tokenizer = Tokenizer.from_file(tokenizer_file)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class _Conversation:
+    """Formatted and counted lines of the most recent turns of one conversation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lines = deque()  # (line, tokens), oldest first
+        self.tokens = 0
+        self.last_id = None
+
+
+class ContextBuilder:
+    """Build prompts from as many recent turns as fit in a token budget.
+
+    The formatted, token-counted turns of each conversation are cached, so
+    a new turn only formats and counts the messages added since the last
+    prompt. Turns that no longer fit in the budget are dropped from the
+    cache, and a newest turn that alone exceeds the budget is cut to fit.
+    The budget covers the prompt only; the reply needs its own room in the
+    model's context window.
+    """
+
+    def __init__(self, token_budget=4096, count_tokens=approximate_tokens,
+                 max_conversations=1000, rebuild_messages=200):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.max_conversations = max_conversations
+        self.rebuild_messages = rebuild_messages
+        self._overhead = count_tokens(INTRO_MESSAGE) + count_tokens(PROMPT_SUFFIX)
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _conversation(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                conversation = self._conversations[conversation_id] = _Conversation()
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            self._conversations.move_to_end(conversation_id)
+            return conversation
+
+    def invalidate(self, conversation_id):
+        """Forget the cached turns of a conversation whose history was rewritten."""
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+    def _truncate(self, line, budget):
+        """Return the longest start of `line` that fits in `budget` tokens with its separator."""
+        low, high = 0, len(line)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(line[:middle]) + 1 <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return line[:low]
+
+    def build(self, conversation_id, history_store):
+        """Return the prompt for the most recent turns of the conversation."""
+        conversation = self._conversation(conversation_id)
+        with time_stage('prompt_build'), conversation.lock:
+            rows = []
+            if conversation.last_id is not None:
+                # The last cached message comes back first unless the history was rewritten elsewhere
+                rows = history_store.since(conversation_id, conversation.last_id)
+                if rows and rows[0]['id'] == conversation.last_id:
+                    rows = rows[1:]
+                else:
+                    conversation.reset()
+            if conversation.last_id is None:
+                rows = history_store.tail(conversation_id, self.rebuild_messages)
+
+            for row in rows:
+                line = format_message(row['role'], row['message'])
+                tokens = self.count_tokens(line) + 1  # Newline separator
+                conversation.lines.append((line, tokens))
+                conversation.tokens += tokens
+                conversation.last_id = row['id']
+
+            budget = max(self.token_budget - self._overhead, 0)
+            while len(conversation.lines) > 1 and conversation.tokens > budget:
+                _, tokens = conversation.lines.popleft()
+                conversation.tokens -= tokens
+            if conversation.tokens > budget:
+                # The newest turn alone exceeds the budget: keep as much of it as fits
+                line, _ = conversation.lines.pop()
+                line = self._truncate(line, budget)
+                tokens = self.count_tokens(line) + 1
+                conversation.lines.append((line, tokens))
+                conversation.tokens = tokens
+
+            formatted_messages = "\n".join(line for line, _ in conversation.lines)
+        return INTRO_MESSAGE + formatted_messages + PROMPT_SUFFIX
@@ -0,0 +1,29 @@
+"""Per-thread SQLite connections for the history, session and response cache stores."""
+import sqlite3
+import threading
+
+
+class ThreadLocalConnection:
+    """Call to get this thread's connection to a SQLite file, opened on first use.
+
+    Connections run in autocommit mode with WAL journaling, so several
+    worker threads and processes can write while others read. `pragmas`
+    run before WAL is enabled, which settings such as auto_vacuum need in
+    order to take effect on a new database.
+    """
+
+    def __init__(self, path, pragmas=()):
+        self.path = path
+        self.pragmas = pragmas
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            for pragma in self.pragmas:
+                conn.execute(f"PRAGMA {pragma}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,131 @@
+"""Per-conversation chat history storage backed by SQLite."""
+import time
+
+from db import ThreadLocalConnection
+from metrics import time_stage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id);
+"""
+
+INCREMENTAL = 2  # PRAGMA auto_vacuum value
+
+
+class HistoryStore:
+    """Append-only chat history keyed by conversation id.
+
+    Each turn is a single-row insert, so the cost of saving does not grow
+    with the length of the conversation. The database runs in WAL mode so
+    several worker processes can append while others read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # auto_vacuum only applies to a new database, and only when set before WAL
+        self._connection = ThreadLocalConnection(path, pragmas=("auto_vacuum = INCREMENTAL",))
+        self._connection().executescript(SCHEMA)
+
+    def append(self, conversation_id, role, message):
+        """Append a single message to a conversation and return its id."""
+        with time_stage('history_save'):
+            return self._connection().execute(
+                "INSERT INTO messages (conversation_id, role, message, created_at) VALUES (?, ?, ?, ?)",
+                (conversation_id, role, message, time.time())
+            ).lastrowid
+
+    def remove(self, conversation_id, message_id):
+        """Delete a single message of a conversation."""
+        self._connection().execute(
+            "DELETE FROM messages WHERE conversation_id = ? AND id = ?", (conversation_id, message_id)
+        )
+
+    def tail(self, conversation_id, limit):
+        """Return the last `limit` messages of a conversation, oldest first."""
+        with time_stage('history_load'):
+            rows = self._connection().execute(
+                "SELECT id, role, message FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [{'id': row_id, 'role': role, 'message': message} for row_id, role, message in reversed(rows)]
+
+    def since(self, conversation_id, message_id):
+        """Return the messages of a conversation from `message_id` onward, oldest first."""
+        with time_stage('history_load'):
+            rows = self._connection().execute(
+                "SELECT id, role, message FROM messages WHERE conversation_id = ? AND id >= ? ORDER BY id",
+                (conversation_id, message_id)
+            ).fetchall()
+        return [{'id': row_id, 'role': role, 'message': message} for row_id, role, message in rows]
+
+    def clear(self, conversation_id):
+        """Delete every message of a conversation."""
+        self._connection().execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+
+    def import_history(self, conversation_id, history):
+        """Make a conversation hold the given messages, in one transaction.
+
+        When the stored messages are the start of `history`, only the new
+        messages are appended; otherwise the conversation is replaced.
+        Returns True if stored messages were replaced.
+        """
+        messages = [(msg.get('role', 'user'), msg.get('message', '')) for msg in history]
+        conn = self._connection()
+        with time_stage('history_save'):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                stored = conn.execute(
+                    "SELECT role, message FROM messages WHERE conversation_id = ? ORDER BY id", (conversation_id,)
+                ).fetchall()
+                replaced = stored != messages[:len(stored)]
+                if replaced:
+                    conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                else:
+                    messages = messages[len(stored):]
+                now = time.time()
+                conn.executemany(
+                    "INSERT INTO messages (conversation_id, role, message, created_at) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, role, message, now) for role, message in messages]
+                )
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return replaced
+
+    def compact(self, keep=None):
+        """Trim each conversation to its last `keep` messages and reclaim disk space.
+
+        Returns the number of messages deleted.
+        """
+        conn = self._connection()
+        deleted = 0
+        if keep is not None:
+            deleted = conn.execute(
+                """
+                DELETE FROM messages WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY conversation_id ORDER BY id DESC
+                        ) AS position
+                        FROM messages
+                    ) WHERE position > ?
+                )
+                """,
+                (keep,)
+            ).rowcount
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == INCREMENTAL:
+            # Each step frees one page; execute() would step only once, executescript() runs to the end
+            conn.executescript("PRAGMA incremental_vacuum;")
+        else:
+            # A database created without incremental auto_vacuum needs one full VACUUM to switch
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
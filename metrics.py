@@ -0,0 +1,189 @@
+"""Prometheus-style counters and histograms for the request hot path."""
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name + '_total', dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, optionally split by labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        for key, entry in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), entry):
+                cumulative += count
+                yield self.name + '_bucket', {**labels, 'le': _format_value(bound)}, cumulative
+            yield self.name + '_sum', labels, entry[-2]
+            yield self.name + '_count', labels, entry[-1]
+
+
+class Registry:
+    """Metrics and stats collectors rendered together in the text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix, collect, descriptions=None):
+        """Expose the dict returned by `collect()` as `<prefix>_<key>` samples on each scrape.
+
+        `descriptions` maps keys to `(kind, documentation)`. Keys of kind
+        'counter' are exposed with a `_total` sample; other numeric values
+        are gauges. String values become a `{value="..."}` sample set to 1.
+        """
+        self._collectors.append((prefix, collect, descriptions or {}))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for prefix, collect, descriptions in self._collectors:
+            for key, value in sorted(collect().items()):
+                if not isinstance(value, (str, int, float)):
+                    continue
+                kind, documentation = descriptions.get(key, ('gauge', None))
+                name = f"{prefix}_{key}"
+                if kind == 'counter' and name.endswith('_total'):
+                    name = name[:-len('_total')]
+                if documentation:
+                    lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                if isinstance(value, str):
+                    lines.append(f"{name}{_format_labels({'value': value})} 1")
+                else:
+                    suffix = '_total' if kind == 'counter' else ''
+                    lines.append(f"{name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'chat_stage_seconds', 'Time spent in each stage of handling a chat request.', ['stage'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'chat_request_seconds', 'Time until response headers, by endpoint and status.', ['endpoint', 'status'])
+GENERATION_ROUNDS = REGISTRY.histogram(
+    'chat_generation_rounds', 'Upstream generation calls made per chat turn.', buckets=(0, 1, 2, 4, 8))
+
+
+def time_stage(stage):
+    """Observe the wall time spent in the block as `chat_stage_seconds{stage=...}`."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+class StageTimer:
+    """Like time_stage(), but leaving out the time spent in `paused()` blocks.
+
+    Wrap the `yield` of a generator in `paused()` so that time spent
+    waiting for a slow consumer is not counted against the stage.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._started = None
+        self._paused_for = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        self._paused_for = 0.0
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self._started - self._paused_for, stage=self.stage)
+
+    @contextlib.contextmanager
+    def paused(self):
+        paused_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._paused_for += time.perf_counter() - paused_at
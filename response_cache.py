@@ -0,0 +1,401 @@
+"""Cache of generated replies with single-flight coalescing of identical prompts."""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from db import ThreadLocalConnection
+
+
+class _Flight:
+    """An upstream generation that concurrent identical requests follow.
+
+    The leader publishes each part of the reply as it arrives and finishes
+    the flight with the complete reply or an error.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self._changed = threading.Condition()
+        self._listeners = []  # Called after every change, for followers on an event loop
+
+    def publish(self, part):
+        with self._changed:
+            self.parts.append(part)
+            self._changed.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def finish(self, result=None, error=None):
+        with self._changed:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._changed.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def wait(self):
+        """Block until the flight is done and return its reply."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def follow(self):
+        """Yield the parts of the reply as they are published, from the first one."""
+        index = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.done or index < len(self.parts))
+                parts = self.parts[index:]
+                done = self.done
+            index += len(parts)
+            yield from parts
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    async def follow_async(self):
+        """Async counterpart of follow() that waits without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(changed.set)
+
+        with self._changed:
+            self._listeners.append(listener)
+        try:
+            index = 0
+            while True:
+                with self._changed:
+                    parts = self.parts[index:]
+                    done = self.done
+                    changed.clear()
+                index += len(parts)
+                for part in parts:
+                    yield part
+                if done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            with self._changed:
+                self._listeners.remove(listener)
+
+
+class ResponseCache:
+    """LRU cache with a TTL for generated replies, with an optional on-disk tier.
+
+    Entries are keyed on the normalized prompt plus the generation
+    parameters. Sampled generations (temperature > 0) are only cached
+    when `cache_sampled` is set. Every `purge_interval` seconds the disk
+    tier drops expired rows and its oldest rows beyond `max_disk_entries`.
+    """
+
+    # Kind and help text of each stats() key, for the /metrics collector
+    STATS = {
+        'hits': ('counter', 'Replies served from the in-memory cache.'),
+        'disk_hits': ('counter', 'Replies served from the on-disk cache.'),
+        'misses': ('counter', 'Cacheable prompts that led a new generation.'),
+        'coalesced': ('counter', 'Requests that followed an identical in-flight generation.'),
+        'bypassed': ('counter', 'Lookups skipped because the generation parameters are not cached.'),
+        'evictions': ('counter', 'Entries evicted from the in-memory cache.'),
+        'disk_purged': ('counter', 'Expired or excess rows deleted from the on-disk cache.'),
+        'entries': ('gauge', 'Entries in the in-memory cache.')
+    }
+
+    def __init__(self, max_entries=1024, ttl=600, disk_path=None, cache_sampled=True,
+                 max_disk_entries=10000, purge_interval=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_sampled = cache_sampled
+        self.max_disk_entries = max_disk_entries
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._tasks = set()  # Async generations, referenced until they finish
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0,
+                          'bypassed': 0, 'evictions': 0, 'disk_purged': 0}
+
+        self.disk_path = disk_path
+        if disk_path:
+            self._connection = ThreadLocalConnection(disk_path)
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._connection().execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def cacheable(self, parameters):
+        """Return True if replies generated with these parameters may be cached."""
+        if self.max_entries <= 0:
+            return False
+        sampled = parameters.get('do_sample', True) and parameters.get('temperature', 1.0) > 0
+        return self.cache_sampled or not sampled
+
+    @staticmethod
+    def key(prompt, parameters):
+        """Return the cache key for a prompt and its generation parameters."""
+        normalized = " ".join(prompt.split())
+        payload = json.dumps({'prompt': normalized, 'parameters': parameters}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, prompt, parameters):
+        """Return the cached reply for the prompt, or None."""
+        text = self._lookup(prompt, parameters)
+        if text is None and self.cacheable(parameters):
+            self._count('misses')
+        return text
+
+    def _lookup(self, prompt, parameters):
+        """Return the cached reply for the prompt, or None, counting hits but not misses."""
+        if not self.cacheable(parameters):
+            self._count('bypassed')
+            return None
+        key = self.key(prompt, parameters)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                text, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return text
+                del self._entries[key]
+
+        if self.disk_path:
+            conn = self._connection()
+            row = conn.execute("SELECT text, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and row[1] > now:
+                self._remember(key, row[0], row[1])
+                self._count('disk_hits')
+                return row[0]
+            if row:
+                conn.execute("DELETE FROM responses WHERE key = ? AND expires_at <= ?", (key, now))
+        return None
+
+    def will_generate(self, prompt, parameters):
+        """Return True unless the reply is cached or already being generated.
+
+        Lets a caller take upstream capacity only when it will lead a new
+        generation. The answer is advisory: a flight can finish between
+        this check and the request joining it. Nothing is counted.
+        """
+        if not self.cacheable(parameters):
+            return True
+        key = self.key(prompt, parameters)
+        now = time.time()
+        with self._lock:
+            if key in self._flights:
+                return False
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+        if self.disk_path:
+            row = self._connection().execute("SELECT expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            return not (row and row[0] > now)
+        return True
+
+    def store(self, prompt, parameters, text):
+        """Cache a generated reply for the prompt."""
+        if not text or not self.cacheable(parameters):
+            return
+        key = self.key(prompt, parameters)
+        expires_at = time.time() + self.ttl
+        self._remember(key, text, expires_at)
+        if self.disk_path:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO responses (key, text, expires_at) VALUES (?, ?, ?)",
+                (key, text, expires_at)
+            )
+            with self._lock:
+                due = time.monotonic() >= self._next_purge
+                if due:
+                    self._next_purge = time.monotonic() + self.purge_interval
+            if due:
+                self.purge_disk()
+
+    def _store_reply(self, prompt, parameters, text):
+        """Cache a reply the leader generated; a failed cache write is logged, not raised.
+
+        The reply itself is good, so the followers waiting on the flight
+        must still receive it.
+        """
+        try:
+            self.store(prompt, parameters, text)
+        except Exception as e:
+            logging.error(f"Failed to cache the generated reply: {e}")
+
+    def purge_disk(self):
+        """Delete expired and excess rows from the disk tier; return how many were removed."""
+        conn = self._connection()
+        deleted = conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),)).rowcount
+        # Rows share one TTL, so the latest expiry is the most recently stored
+        deleted += conn.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        ).rowcount
+        with self._lock:
+            self._counters['disk_purged'] += deleted
+        return deleted
+
+    def _remember(self, key, text, expires_at):
+        with self._lock:
+            self._entries[key] = (text, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _join(self, key):
+        """Return the flight generating `key` and whether the caller leads it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._counters['coalesced'] += 1
+                return flight, False
+            self._counters['misses'] += 1
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _finish(self, key, flight, result=None, error=None):
+        """Retire the flight and hand the leader's reply (or its error) to the followers."""
+        with self._lock:
+            del self._flights[key]
+        flight.finish(result, error)
+
+    def get_or_generate(self, prompt, parameters, generate):
+        """Return the cached reply, or call `generate()` once for all identical concurrent requests."""
+        cached = self._lookup(prompt, parameters)
+        if cached is not None:
+            return cached
+        if not self.cacheable(parameters):
+            return generate()
+
+        key = self.key(prompt, parameters)
+        flight, leader = self._join(key)
+        if not leader:
+            return flight.wait()
+
+        try:
+            result = generate()
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            raise
+        flight.publish(result)
+        self._store_reply(prompt, parameters, result)
+        self._finish(key, flight, result)
+        return result
+
+    def stream_or_generate(self, prompt, parameters, stream):
+        """Yield the reply in parts, calling `stream()` once for all identical concurrent requests.
+
+        `stream()` returns an iterator of reply parts. The first request
+        for a prompt calls it; identical requests that arrive meanwhile
+        receive the same parts as they are produced. If the leading
+        client goes away, the generation still runs to the end for the
+        followers and the cache.
+        """
+        cached = self._lookup(prompt, parameters)
+        if cached is not None:
+            yield cached
+            return
+        if not self.cacheable(parameters):
+            yield from stream()
+            return
+
+        key = self.key(prompt, parameters)
+        flight, leader = self._join(key)
+        if not leader:
+            yield from flight.follow()
+            return
+
+        parts = stream()
+        error = None
+        try:
+            for part in parts:
+                flight.publish(part)
+                yield part
+        except GeneratorExit:
+            # The client went away: finish the reply for the followers and the cache
+            try:
+                for part in parts:
+                    flight.publish(part)
+            except Exception as e:
+                error = e
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            result = None
+            if error is None:
+                result = "".join(flight.parts).strip()
+                self._store_reply(prompt, parameters, result)
+            self._finish(key, flight, result, error)
+
+    async def stream_or_generate_async(self, prompt, parameters, stream):
+        """Async counterpart of stream_or_generate(); `stream()` returns an async iterator.
+
+        The leader's generation runs in its own task, so cancelling the
+        request that started it does not cancel it for the followers.
+        """
+        cached = await asyncio.to_thread(self._lookup, prompt, parameters)
+        if cached is not None:
+            yield cached
+            return
+        if not self.cacheable(parameters):
+            async for part in stream():
+                yield part
+            return
+
+        key = self.key(prompt, parameters)
+        flight, leader = self._join(key)
+        if leader:
+            task = asyncio.create_task(self._lead_async(key, flight, prompt, parameters, stream))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        async for part in flight.follow_async():
+            yield part
+
+    async def _lead_async(self, key, flight, prompt, parameters, stream):
+        """Run an async generation to the end, publishing its parts to the flight."""
+        try:
+            async for part in stream():
+                flight.publish(part)
+            result = "".join(flight.parts).strip()
+            await asyncio.to_thread(self._store_reply, prompt, parameters, result)
+        except asyncio.CancelledError:
+            self._finish(key, flight, error=RuntimeError("Generation was cancelled"))
+            raise
+        except Exception as e:
+            self._finish(key, flight, error=e)
+            return
+        self._finish(key, flight, result)
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached entries."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        return stats
@@ -0,0 +1,228 @@
+"""Admission control and fair queueing for calls to the upstream model."""
+import asyncio
+import contextlib
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import STAGE_SECONDS
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request cannot be admitted; `retry_after` is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """A queued request, woken by `notify` once it has been granted a slot."""
+
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+
+
+class UpstreamScheduler:
+    """Cap in-flight upstream calls and share them fairly between sessions.
+
+    Each session has a token bucket refilled at `rate` requests per second
+    up to `burst`. Admitted requests beyond `max_inflight` wait in
+    per-session queues that are served round-robin, so one busy session
+    cannot starve the others. When the queue is full, or a request waits
+    longer than `queue_timeout`, SchedulerOverloaded is raised with a
+    suggested Retry-After.
+    """
+
+    # Kind and help text of each stats() key, for the /metrics collector
+    STATS = {
+        'admitted': ('counter', 'Requests granted an upstream slot.'),
+        'queued': ('counter', 'Requests that waited in the queue for a slot.'),
+        'rejected': ('counter', 'Requests turned away by the rate limit or a full queue.'),
+        'timed_out': ('counter', 'Requests that gave up waiting for a slot.'),
+        'wait_seconds_total': ('counter', 'Time admitted requests spent waiting for a slot.'),
+        'wait_seconds_max': ('gauge', 'Longest time a request has waited for a slot.'),
+        'inflight': ('gauge', 'Upstream slots in use.'),
+        'queue_depth': ('gauge', 'Requests waiting for a slot.'),
+        'sessions_queued': ('gauge', 'Sessions with requests waiting for a slot.')
+    }
+
+    def __init__(self, max_inflight=8, max_queue=32, queue_timeout=30.0,
+                 rate=0.5, burst=5, max_sessions=10000):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.max_sessions = max_sessions
+
+        self._inflight = 0
+        self._queued = 0
+        self._queues = OrderedDict()  # session id -> deque of waiters, in round-robin order
+        self._buckets = OrderedDict()  # session id -> (tokens, last refill)
+        self._service_time = 1.0  # Moving average of how long a slot is held
+        self._lock = threading.Lock()
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0,
+                          'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+
+    # Bookkeeping, called with the lock held
+
+    def _take_token(self, session_id):
+        """Take a token from the session's bucket, or return the seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(session_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[session_id] = (tokens, now)
+        while len(self._buckets) > self.max_sessions:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def _retry_after(self):
+        """Estimate how long until a slot frees up for a new request."""
+        slots_ahead = self._queued + 1
+        return max(1, math.ceil(self._service_time * slots_ahead / self.max_inflight))
+
+    def _admit(self, session_id, waiter):
+        """Grant a slot now (True), queue the waiter (False) or raise SchedulerOverloaded."""
+        free = self._inflight < self.max_inflight and not self._queued
+        # Check the queue before the bucket, so a request turned away does not spend a token
+        if not free and self._queued >= self.max_queue:
+            self._counters['rejected'] += 1
+            raise SchedulerOverloaded("Upstream queue is full", self._retry_after())
+        wait = self._take_token(session_id)
+        if wait:
+            self._counters['rejected'] += 1
+            raise SchedulerOverloaded("Too many requests from this session", math.ceil(wait))
+        if free:
+            self._inflight += 1
+            self._counters['admitted'] += 1
+            return True
+        self._queues.setdefault(session_id, deque()).append(waiter)
+        self._queued += 1
+        self._counters['queued'] += 1
+        return False
+
+    def _grant_next(self):
+        """Hand free slots to queued waiters, one session at a time."""
+        while self._inflight < self.max_inflight and self._queues:
+            session_id, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            self._queued -= 1
+            self._inflight += 1
+            self._counters['admitted'] += 1
+            waiter.granted = True
+            waiter.notify()
+
+    def _withdraw(self, session_id, waiter):
+        """Remove a waiter that gave up; return False if it was granted a slot meanwhile."""
+        if waiter.granted:
+            return False
+        queue = self._queues[session_id]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[session_id]
+        self._queued -= 1
+        self._counters['timed_out'] += 1
+        return True
+
+    def _record_wait(self, started):
+        waited = time.monotonic() - started
+        STAGE_SECONDS.observe(waited, stage='queue_wait')
+        with self._lock:
+            self._counters['wait_seconds_total'] += waited
+            self._counters['wait_seconds_max'] = max(self._counters['wait_seconds_max'], waited)
+        return waited
+
+    # Public interface
+
+    def acquire(self, session_id):
+        """Block until the session may call the upstream; return the seconds spent queued."""
+        started = time.monotonic()
+        event = threading.Event()
+        waiter = _Waiter(event.set)
+        with self._lock:
+            admitted = self._admit(session_id, waiter)
+        if admitted:
+            return self._record_wait(started)
+        if not event.wait(self.queue_timeout):
+            with self._lock:
+                if self._withdraw(session_id, waiter):
+                    raise SchedulerOverloaded("Timed out waiting for the upstream", self._retry_after())
+        return self._record_wait(started)
+
+    async def acquire_async(self, session_id):
+        """Wait without blocking the event loop until the session may call the upstream."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = _Waiter(notify)
+        with self._lock:
+            admitted = self._admit(session_id, waiter)
+        if admitted:
+            return self._record_wait(started)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                withdrawn = self._withdraw(session_id, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                if not withdrawn:
+                    self.release()
+                raise
+            if withdrawn:
+                raise SchedulerOverloaded("Timed out waiting for the upstream", self._retry_after())
+        return self._record_wait(started)
+
+    def release(self, held_for=None):
+        """Give back a slot obtained from acquire() and wake the next waiter.
+
+        `held_for` is how long the slot was held, used to estimate Retry-After.
+        """
+        with self._lock:
+            self._inflight -= 1
+            if held_for is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * held_for
+            self._grant_next()
+
+    @contextlib.contextmanager
+    def slot(self, session_id):
+        """Hold an upstream slot for the duration of the block; yields the seconds spent queued."""
+        waited = self.acquire(session_id)
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(time.monotonic() - started)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, session_id):
+        """Async counterpart of slot()."""
+        waited = await self.acquire_async(session_id)
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        """Return in-flight and queue sizes and admission counters."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'inflight': self._inflight, 'queue_depth': self._queued,
+                          'sessions_queued': len(self._queues)})
+        return stats
@@ -0,0 +1,177 @@
+"""Server-side Flask sessions: the cookie only carries a signed session id."""
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from db import ThreadLocalConnection
+from metrics import time_stage
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept on the server under an opaque id."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class MemorySessionBackend:
+    """In-process session storage with LRU eviction and an idle TTL."""
+
+    def __init__(self, max_entries=10000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            now = time.monotonic()
+            if expires_at < now:
+                del self._entries[sid]
+                return None
+            self._entries[sid] = (data, now + self.ttl)  # Reading a session keeps it alive
+            self._entries.move_to_end(sid)
+            return dict(data)
+
+    def set(self, sid, data):
+        with self._lock:
+            self._entries[sid] = (dict(data), time.monotonic() + self.ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class SQLiteSessionBackend:
+    """Session storage shared by all worker processes through a SQLite file.
+
+    Sessions expire `ttl` seconds after they were last used. To avoid a
+    write on every request, the expiry is only pushed back once less than
+    half of the TTL is left. Expired sessions are deleted at most every
+    `purge_interval` seconds, when a session is saved.
+    """
+
+    def __init__(self, path, ttl=86400, purge_interval=300):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._purge_lock = threading.Lock()
+        self._connection = ThreadLocalConnection(path)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)")
+
+    def get(self, sid):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?", (sid, now)
+        ).fetchone()
+        if row is None:
+            return None
+        data, expires_at = row
+        if expires_at - now < self.ttl / 2:
+            conn.execute("UPDATE sessions SET expires_at = ? WHERE sid = ?", (now + self.ttl, sid))
+        return json.loads(data)
+
+    def set(self, sid, data):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)",
+            (sid, json.dumps(data, separators=(',', ':')), now + self.ttl)
+        )
+        with self._purge_lock:
+            due = now >= self._next_purge
+            if due:
+                self._next_purge = now + self.purge_interval
+        if due:
+            self.purge_expired()
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def purge_expired(self):
+        """Delete expired sessions and return how many were removed."""
+        return self._connection().execute(
+            "DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)
+        ).rowcount
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keep session data in a backend and only a signed session id in the cookie."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        return self.load(app, request.cookies.get(self.get_cookie_name(app)))
+
+    def load(self, app, cookie):
+        """Return the session for a cookie value, or a new empty one."""
+        with time_stage('session_load'):
+            if cookie:
+                try:
+                    sid = self._signer(app).unsign(cookie).decode()
+                except BadSignature:
+                    sid = None
+                data = self.backend.get(sid) if sid else None
+                if data is not None:
+                    return ServerSideSession(data, sid=sid)
+            return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def cookie_value(self, app, session):
+        """Return the signed cookie value for a session."""
+        return self._signer(app).sign(session.sid).decode()
+
+    def save_session(self, app, session, response):
+        with time_stage('session_save'):
+            self._save_session(app, session, response)
+
+    def _save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            self.backend.set(session.sid, dict(session))
+
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self.cookie_value(app, session),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
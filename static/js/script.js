@@ -3,20 +3,6 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatContainer = document.getElementById('chat-container');
     const promptInput = document.getElementById('prompt');
 
-    // Function to simulate typing effect
-    function typeMessage(messageElement, message, typingSpeed = 10) {
-        let index = 0;
-        messageElement.innerHTML = ''; // Clear any previous message content
-        let interval = setInterval(() => {
-            messageElement.innerHTML += message[index];
-            index++;
-            scrollToBottom(); // Scroll to the bottom after each character is added
-            if (index === message.length) {
-                clearInterval(interval); // Stop typing when the message is complete
-            }
-        }, typingSpeed);
-    }
-
     // Submit event listener for the form
     form.addEventListener('submit', async (e) => {
         e.preventDefault();
@@ -33,35 +19,80 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const response = await fetch('/get_response', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept': 'text/event-stream'
+                },
                 body: `prompt=${encodeURIComponent(userInput)}`
             });
-            const data = await response.json();
 
-            // Remove typing indicator
-            removeTypingIndicator();
-
-            if (data.error) {
-                // Handle API errors gracefully
-                addMessage('assistant', data.error);
+            const contentType = response.headers.get('Content-Type') || '';
+            if (contentType.startsWith('text/event-stream')) {
+                // Render tokens as the server streams them
+                await readStream(response);
             } else {
-                // Create the AI message element
-                const aiMessageElement = document.createElement('div');
-                aiMessageElement.classList.add('message', 'assistant');
-                chatContainer.appendChild(aiMessageElement);
+                const data = await response.json();
 
-                // Call the typeMessage function to simulate the typing effect for the AI's response
-                typeMessage(aiMessageElement, data.message);
-            }
+                // Remove typing indicator
+                removeTypingIndicator();
 
-            // Save chat history to the server
-            saveChatHistory();
+                // Handle API errors gracefully
+                addMessage('assistant', data.error || data.message);
+            }
         } catch (error) {
             console.error('Error fetching AI response:', error);
+            removeTypingIndicator();
             addMessage('assistant', 'Error fetching AI response. Please try again later.');
         }
     });
 
+    // Read Server-Sent Events from the response and append tokens to a new AI message
+    async function readStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let bubble = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const event = parseEvent(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+
+                if (!bubble) {
+                    removeTypingIndicator();
+                    bubble = addMessage('assistant', '');
+                }
+                if (event.type === 'error') {
+                    bubble.textContent = event.data.error;
+                } else if (event.type === 'done') {
+                    bubble.textContent = event.data.message;
+                } else {
+                    bubble.textContent += event.data.token;
+                }
+                scrollToBottom();
+            }
+        }
+    }
+
+    // Parse a single Server-Sent Event block into its type and JSON data
+    function parseEvent(raw) {
+        let type = 'message';
+        let data = '';
+        raw.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                type = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                data += line.slice(5).trim();
+            }
+        });
+        return { type, data: JSON.parse(data) };
+    }
+
     // Function to add messages to the chat container
     function addMessage(role, message) {
         const messageElement = document.createElement('div');
@@ -69,6 +100,7 @@ document.addEventListener('DOMContentLoaded', () => {
         messageElement.innerHTML = `<div class="bubble">${message}</div>`;
         chatContainer.appendChild(messageElement);
         scrollToBottom(); // Scroll to the bottom when a new message is added
+        return messageElement.querySelector('.bubble');
     }
 
     // Clear chat history event listener
@@ -103,28 +135,6 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    // Save chat history to the server
-    async function saveChatHistory() {
-        const messages = Array.from(chatContainer.getElementsByClassName('message')).map(messageElement => {
-            const role = messageElement.classList.contains('user') ? 'user' : 'assistant';
-            const messageElementBubble = messageElement.querySelector('.bubble');
-            const message = messageElementBubble ? messageElementBubble.textContent : '';
-            return { role, message };
-        });
-
-        try {
-            await fetch('/save_history', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ history: messages })
-            });
-            // Save history to session storage as well
-            sessionStorage.setItem('chatHistory', JSON.stringify(messages));
-        } catch (error) {
-            console.error('Error saving chat history:', error);
-        }
-    }
-
     // Function to show typing indicator
     function showTypingIndicator() {
         const typingIndicator = document.createElement('div');
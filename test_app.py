@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from response_cache import ResponseCache
+
+SSE = {'Accept': 'text/event-stream'}
+
+
+@pytest.fixture
+def chat(chat_app, mock_upstream, monkeypatch):
+    """A test client for a new conversation against the local stand-in; returns (client, MockState)."""
+    url, state = mock_upstream
+    monkeypatch.setattr(chat_app, 'API_URL', url)
+    monkeypatch.setattr(chat_app, 'response_cache', ResponseCache())
+    return chat_app.app.test_client(), state
+
+
+def events(body):
+    """Parse a Server-Sent Events body into (event, data) pairs."""
+    parsed = []
+    for block in body.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        parsed.append((fields.get('event', 'message'), json.loads(fields['data'])))
+    return parsed
+
+
+def stored_messages(chat_app, client):
+    with client.session_transaction() as session:
+        conversation_id = session['conversation_id']
+    return [(row['role'], row['message']) for row in chat_app.history_store.tail(conversation_id, 10)]
+
+
+def test_cut_at_stop(chat_app):
+    cut_at_stop = chat_app.cut_at_stop
+    assert cut_at_stop('Hi there') == ('Hi there', '', False)
+    assert cut_at_stop('Hi\nUser: next') == ('Hi', '', True)
+    assert cut_at_stop('Hi\nUs') == ('Hi', '\nUs', False)  # May be the start of "\nUser:"
+    assert cut_at_stop('Hi\n') == ('Hi', '\n', False)
+    assert cut_at_stop('Hi\nUsage') == ('Hi\nUsage', '', False)
+
+
+def test_parse_stream_line(chat_app):
+    parse_stream_line = chat_app.parse_stream_line
+    assert parse_stream_line('') is None
+    assert parse_stream_line(':keep-alive') is None
+    assert parse_stream_line('data:{"token": {"id": 1, "text": "Hi", "special": false}}') == 'Hi'
+    assert parse_stream_line('data:{"token": {"id": 2, "text": "</s>", "special": true}}') is None
+    with pytest.raises(RuntimeError, match='overloaded'):
+        parse_stream_line('data:{"error": "Model is overloaded", "error_type": "overloaded"}')
+
+
+def test_stream_stops_at_a_stop_sequence_split_across_tokens(chat_app, chat):
+    client, state = chat
+    state.script = ['Hello', ' there', '\n', 'Us', 'er:', ' more']
+
+    response = client.post('/get_response', data={'prompt': 'hello'}, headers=SSE)
+    assert response.mimetype == 'text/event-stream'
+    assert events(response.get_data(as_text=True)) == [
+        ('message', {'token': 'Hello'}),
+        ('message', {'token': ' there'}),
+        ('done', {'message': 'Hello there'})
+    ]
+    assert stored_messages(chat_app, client)[-1] == ('assistant', 'Hello there')
+
+
+def test_stream_flushes_a_held_back_tail_at_the_end(chat_app, chat):
+    client, state = chat
+    state.script = ['Hi', '\nU']
+
+    response = client.post('/get_response', data={'prompt': 'hello'}, headers=SSE)
+    assert events(response.get_data(as_text=True)) == [
+        ('message', {'token': 'Hi'}),
+        ('message', {'token': '\nU'}),
+        ('done', {'message': 'Hi\nU'})
+    ]
+
+
+def test_stream_reports_an_upstream_error_event(chat_app, chat):
+    client, state = chat
+    state.script = ['partial ']
+    state.stream_error = 'Model is overloaded'
+
+    response = client.post('/get_response', data={'prompt': 'hello'}, headers=SSE)
+    assert events(response.get_data(as_text=True)) == [
+        ('message', {'token': 'partial '}),
+        ('error', {'error': 'Error: Model is overloaded'})
+    ]
+    assert stored_messages(chat_app, client) == [('user', 'hello')]
+
+
+def test_reply_is_stored_only_once_the_stream_completes(chat_app, chat):
+    client, state = chat
+    state.script = ['one ', 'two ', 'three']
+    state.token_rate = 20
+
+    response = client.post('/get_response', data={'prompt': 'hello'}, headers=SSE)
+    chunks = response.iter_encoded()
+    assert events(next(chunks).decode()) == [('message', {'token': 'one '})]
+    assert stored_messages(chat_app, client) == [('user', 'hello')]
+
+    rest = b''.join(chunks).decode()
+    assert events(rest)[-1] == ('done', {'message': 'one two three'})
+    assert stored_messages(chat_app, client) == [('user', 'hello'), ('assistant', 'one two three')]
+
+
+def test_json_reply_is_cut_at_the_stop_sequence(chat_app, chat):
+    client, state = chat
+    state.script = ['Sure', '\nUser:', ' again']
+
+    response = client.post('/get_response', data={'prompt': 'hello'})
+    assert response.get_json() == {'message': 'Sure'}
+    assert stored_messages(chat_app, client) == [('user', 'hello'), ('assistant', 'Sure')]
@@ -0,0 +1,210 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import metrics
+from response_cache import ResponseCache
+from scheduler import UpstreamScheduler
+from upstream import AsyncUpstreamClient, CircuitBreaker
+
+SSE = {'Accept': 'text/event-stream'}
+
+
+@pytest.fixture
+def asgi(chat_app, mock_upstream, monkeypatch):
+    """The asgi module, pointed at the local stand-in with a fresh cache and scheduler."""
+    import asgi
+
+    url, _ = mock_upstream
+    monkeypatch.setattr(asgi, 'API_URL', url)
+    monkeypatch.setattr(asgi, 'response_cache', ResponseCache())
+    monkeypatch.setattr(asgi, 'scheduler', UpstreamScheduler())
+    return asgi
+
+
+@pytest.fixture
+def application(asgi, chat_app):
+    """A new AsyncChatApp with its own upstream client, so each test's event loop gets one."""
+    application = asgi.AsyncChatApp(chat_app.app)
+    application.upstream = AsyncUpstreamClient(breaker=CircuitBreaker())
+    return application
+
+
+def serve(application, *requests):
+    """Send the (method, path, kwargs) requests in order from one client; return the client and responses."""
+    async def main():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            responses = [await client.request(method, path, **kwargs) for method, path, kwargs in requests]
+        await application.upstream.aclose()
+        return client, responses
+
+    return asyncio.run(main())
+
+
+def events(body):
+    """Parse a Server-Sent Events body into (event, data) pairs."""
+    parsed = []
+    for block in body.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        parsed.append((fields.get('event', 'message'), json.loads(fields['data'])))
+    return parsed
+
+
+def conversation(chat_app, client):
+    """Return the stored (role, message) pairs of the client's conversation."""
+    interface = chat_app.app.session_interface
+    session = interface.load(chat_app.app, client.cookies.get(interface.get_cookie_name(chat_app.app)))
+    rows = chat_app.history_store.tail(session['conversation_id'], 10)
+    return [(row['role'], row['message']) for row in rows]
+
+
+def test_get_response_replies_and_keeps_the_conversation(application, chat_app, mock_upstream):
+    _, state = mock_upstream
+    state.script = ['Hi', ' there']
+    client, responses = serve(application,
+                              ('POST', '/get_response', {'data': {'prompt': 'hello'}}),
+                              ('POST', '/get_response', {'data': {'prompt': 'again'}}))
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].json() == {'message': 'Hi there'}
+    assert 'set-cookie' in responses[0].headers
+    assert float(responses[0].headers['x-queue-wait']) < 0.1
+    assert conversation(chat_app, client) == [('user', 'hello'), ('assistant', 'Hi there'),
+                                              ('user', 'again'), ('assistant', 'Hi there')]
+
+
+def test_get_response_streams_server_sent_events(application, chat_app, mock_upstream):
+    _, state = mock_upstream
+    state.script = ['Hello', ' there', '\n', 'Us', 'er:', ' more']
+    client, (response,) = serve(application, ('POST', '/get_response', {'data': {'prompt': 'hello'},
+                                                                         'headers': SSE}))
+
+    assert response.headers['content-type'] == 'text/event-stream; charset=utf-8'
+    assert response.headers['cache-control'] == 'no-cache'
+    assert events(response.text) == [
+        ('message', {'token': 'Hello'}),
+        ('message', {'token': ' there'}),
+        ('done', {'message': 'Hello there'})
+    ]
+    assert conversation(chat_app, client)[-1] == ('assistant', 'Hello there')
+
+
+def test_get_response_streams_an_upstream_error(application, chat_app, mock_upstream):
+    _, state = mock_upstream
+    state.script = ['partial ']
+    state.stream_error = 'Model is overloaded'
+    client, (response,) = serve(application, ('POST', '/get_response', {'data': {'prompt': 'hello'},
+                                                                         'headers': SSE}))
+
+    assert events(response.text) == [
+        ('message', {'token': 'partial '}),
+        ('error', {'error': 'Error: Model is overloaded'})
+    ]
+    assert conversation(chat_app, client) == [('user', 'hello')]
+
+
+def test_get_response_rejects_an_empty_prompt(application):
+    _, (response,) = serve(application, ('POST', '/get_response', {'data': {'prompt': '  '}}))
+    assert response.status_code == 400
+    assert response.json() == {'error': 'Prompt cannot be empty'}
+
+
+def test_get_response_answers_429_when_the_queue_is_full(asgi, application, chat_app, monkeypatch):
+    scheduler = UpstreamScheduler(max_inflight=1, max_queue=0)
+    monkeypatch.setattr(asgi, 'scheduler', scheduler)
+    scheduler.acquire('holder')
+
+    client, (response,) = serve(application, ('POST', '/get_response', {'data': {'prompt': 'hello'}}))
+    assert response.status_code == 429
+    assert int(response.headers['retry-after']) >= 1
+    assert 'set-cookie' in response.headers
+    assert conversation(chat_app, client) == []  # The rejected turn is not kept
+
+
+def test_inference_returns_the_upstream_reply(application):
+    _, (response,) = serve(application, ('POST', '/api/inference', {'json': {'inputs': 'hi'}}))
+    assert response.status_code == 200
+    assert 'generated_text' in response.json()[0]
+    assert 'set-cookie' in response.headers
+
+
+def test_inference_rejects_a_body_that_is_not_json(application):
+    _, (response,) = serve(application, ('POST', '/api/inference', {'content': b'not json'}))
+    assert response.status_code == 400
+    assert 'set-cookie' in response.headers
+
+
+def test_inference_answers_503_while_the_breaker_is_open(application, mock_upstream):
+    _, state = mock_upstream
+    application.upstream.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    application.upstream.breaker.record_failure()
+
+    _, (response,) = serve(application, ('POST', '/api/inference', {'json': {'inputs': 'hi'}}))
+    assert response.status_code == 503
+    assert 'set-cookie' in response.headers
+    assert state.stats()['requests'] == 0
+
+
+def test_other_routes_are_served_by_flask(application):
+    _, responses = serve(application,
+                         ('GET', '/', {}),
+                         ('GET', '/api/cache_stats', {}),
+                         ('POST', '/save_history', {'json': {'history': 'not a list'}}))
+
+    assert [response.status_code for response in responses] == [200, 200, 400]
+    assert responses[0].headers['content-type'].startswith('text/html')
+    assert 'set-cookie' in responses[0].headers
+    assert 'hits' in responses[1].json()
+
+
+def test_wsgi_environ(asgi):
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': '/save_history', 'root_path': '',
+        'query_string': b'a=1', 'http_version': '1.1', 'scheme': 'http',
+        'server': ('example.com', 8000), 'client': ('10.0.0.1', 5000),
+        'headers': [(b'content-type', b'application/json'), (b'content-length', b'2'),
+                    (b'cookie', b'a=1'), (b'cookie', b'session=abc'),
+                    (b'x-forwarded-for', b'10.0.0.2'), (b'x-forwarded-for', b'10.0.0.3')]
+    }
+    environ = asgi.wsgi_environ(scope, b'{}')
+
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert (environ['PATH_INFO'], environ['QUERY_STRING']) == ('/save_history', 'a=1')
+    assert (environ['SERVER_NAME'], environ['SERVER_PORT']) == ('example.com', '8000')
+    assert environ['REMOTE_ADDR'] == '10.0.0.1'
+    assert (environ['CONTENT_TYPE'], environ['CONTENT_LENGTH']) == ('application/json', '2')
+    assert environ['HTTP_COOKIE'] == 'a=1; session=abc'
+    assert environ['HTTP_X_FORWARDED_FOR'] == '10.0.0.2,10.0.0.3'
+    assert environ['wsgi.input'].read() == b'{}'
+
+
+def test_session_cookie_is_found_in_a_repeated_cookie_header(application, chat_app):
+    client, _ = serve(application, ('POST', '/get_response', {'data': {'prompt': 'hello'}}))
+    name = chat_app.app.session_interface.get_cookie_name(chat_app.app)
+    scope = {'headers': [(b'cookie', b'other=1'), (b'cookie', f'{name}={client.cookies[name]}'.encode())]}
+
+    assert application.header(scope, 'cookie') == f'other=1; {name}={client.cookies[name]}'
+    assert 'conversation_id' in application.open_session(scope)
+
+
+def test_lifespan_opens_and_closes_the_upstream_client(asgi, chat_app, monkeypatch):
+    monkeypatch.setattr(metrics.REGISTRY, '_collectors', list(metrics.REGISTRY._collectors))
+    application = asgi.AsyncChatApp(chat_app.app)
+
+    async def main():
+        messages = asyncio.Queue()
+        for message in ('lifespan.startup', 'lifespan.shutdown'):
+            messages.put_nowait({'type': message})
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await application({'type': 'lifespan'}, messages.get, send)
+        return sent
+
+    assert asyncio.run(main()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert application.upstream.client.is_closed
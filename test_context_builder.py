@@ -0,0 +1,97 @@
+from context_builder import INTRO_MESSAGE, PROMPT_SUFFIX, ContextBuilder, approximate_tokens
+from history_store import HistoryStore
+
+
+class CountingTokens:
+    """approximate_tokens that records the text it was asked to count."""
+
+    def __init__(self):
+        self.counted = []
+
+    def __call__(self, text):
+        self.counted.append(text)
+        return approximate_tokens(text)
+
+
+def prompt_tokens(prompt):
+    return approximate_tokens(INTRO_MESSAGE) + approximate_tokens(PROMPT_SUFFIX) + sum(
+        approximate_tokens(line) + 1 for line in prompt[len(INTRO_MESSAGE):-len(PROMPT_SUFFIX)].split('\n'))
+
+
+def make_store(tmp_path, messages=()):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    for role, message in messages:
+        store.append('c', role, message)
+    return store
+
+
+def test_packs_the_most_recent_turns_that_fit(tmp_path):
+    store = make_store(tmp_path, [('user', f'message {i} ' + 'x' * 36) for i in range(20)])
+    builder = ContextBuilder(token_budget=100)
+    prompt = builder.build('c', store)
+
+    assert prompt.startswith(INTRO_MESSAGE) and prompt.endswith(PROMPT_SUFFIX)
+    assert 'message 19 ' in prompt
+    assert 'message 0 ' not in prompt
+    assert prompt_tokens(prompt) <= 100
+
+
+def test_only_new_messages_are_counted_on_the_next_turn(tmp_path):
+    store = make_store(tmp_path, [('user', 'hello'), ('assistant', 'hi there')])
+    counter = CountingTokens()
+    builder = ContextBuilder(token_budget=1000, count_tokens=counter)
+    builder.build('c', store)
+
+    counter.counted.clear()
+    store.append('c', 'user', 'how are you?')
+    prompt = builder.build('c', store)
+    assert counter.counted == ['User: how are you?']
+    assert prompt == INTRO_MESSAGE + "User: hello\nAssistant: hi there\nUser: how are you?" + PROMPT_SUFFIX
+
+
+def test_rewritten_history_is_rebuilt(tmp_path):
+    store = make_store(tmp_path, [('user', 'old question'), ('assistant', 'old answer')])
+    builder = ContextBuilder(token_budget=1000)
+    builder.build('c', store)
+
+    store.import_history('c', [{'role': 'user', 'message': 'new question'}])
+    assert builder.build('c', store) == INTRO_MESSAGE + "User: new question" + PROMPT_SUFFIX
+
+    store.clear('c')
+    store.append('c', 'user', 'after clear')
+    assert builder.build('c', store) == INTRO_MESSAGE + "User: after clear" + PROMPT_SUFFIX
+
+
+def test_invalidate_forgets_cached_turns(tmp_path):
+    store = make_store(tmp_path, [('user', 'hello')])
+    counter = CountingTokens()
+    builder = ContextBuilder(token_budget=1000, count_tokens=counter)
+    builder.build('c', store)
+    builder.invalidate('c')
+
+    counter.counted.clear()
+    builder.build('c', store)
+    assert counter.counted == ['User: hello']
+
+
+def test_oversized_newest_message_is_cut_to_the_budget(tmp_path):
+    store = make_store(tmp_path, [('user', 'short'), ('user', 'y' * 4000)])
+    builder = ContextBuilder(token_budget=200)
+    prompt = builder.build('c', store)
+
+    assert 'short' not in prompt
+    assert prompt.startswith(INTRO_MESSAGE + 'User: yyy')
+    assert prompt_tokens(prompt) <= 200
+
+    store.append('c', 'assistant', 'ok')
+    prompt = builder.build('c', store)
+    assert prompt_tokens(prompt) <= 200
+    assert prompt.endswith('Assistant: ok' + PROMPT_SUFFIX)
+
+
+def test_conversations_are_evicted_least_recently_used_first(tmp_path):
+    store = make_store(tmp_path)
+    builder = ContextBuilder(max_conversations=2)
+    for conversation_id in ('a', 'b', 'a', 'c'):
+        builder.build(conversation_id, store)
+    assert list(builder._conversations) == ['a', 'c']
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+
+import pytest
+
+from history_store import HistoryStore
+
+
+def database_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / 'history.db'))
+
+
+def messages(rows):
+    return [(row['role'], row['message']) for row in rows]
+
+
+def test_append_and_tail_keep_conversations_apart(store):
+    for i in range(5):
+        store.append('a', 'user' if i % 2 == 0 else 'assistant', f'a{i}')
+    store.append('b', 'user', 'b0')
+    assert messages(store.tail('a', 3)) == [('user', 'a2'), ('assistant', 'a3'), ('user', 'a4')]
+    assert messages(store.tail('b', 10)) == [('user', 'b0')]
+    assert store.tail('missing', 10) == []
+
+
+def test_since_returns_messages_from_an_id_onward(store):
+    for i in range(4):
+        store.append('a', 'user', f'a{i}')
+    first, second = store.tail('a', 4)[:2]
+    assert messages(store.since('a', second['id'])) == [('user', 'a1'), ('user', 'a2'), ('user', 'a3')]
+    assert store.since('a', first['id'])[0]['id'] == first['id']
+
+
+def test_clear_only_deletes_one_conversation(store):
+    store.append('a', 'user', 'hello')
+    store.append('b', 'user', 'hello')
+    store.clear('a')
+    assert store.tail('a', 10) == []
+    assert messages(store.tail('b', 10)) == [('user', 'hello')]
+
+
+def test_import_history_appends_only_new_messages_to_a_matching_prefix(store):
+    store.append('a', 'user', 'hi')
+    stored_id = store.tail('a', 1)[0]['id']
+    history = [{'role': 'user', 'message': 'hi'}, {'role': 'assistant', 'message': 'hello'}]
+
+    assert store.import_history('a', history) is False
+    rows = store.tail('a', 10)
+    assert messages(rows) == [('user', 'hi'), ('assistant', 'hello')]
+    assert rows[0]['id'] == stored_id
+
+
+def test_import_history_replaces_a_diverging_conversation(store):
+    store.append('a', 'user', 'hi')
+    store.append('a', 'assistant', 'hello')
+
+    assert store.import_history('a', [{'message': 'other'}]) is True
+    assert messages(store.tail('a', 10)) == [('user', 'other')]
+
+
+def test_import_history_rolls_back_on_error(store):
+    store.append('a', 'user', 'hi')
+    with pytest.raises(sqlite3.Error):
+        store.import_history('a', [{'role': 'user', 'message': ['not', 'text']}])
+    assert messages(store.tail('a', 10)) == [('user', 'hi')]
+
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    assert store._connection().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_compact_trims_conversations_and_shrinks_the_file(tmp_path):
+    path = str(tmp_path / 'history.db')
+    store = HistoryStore(path)
+    for i in range(400):
+        store.append('c', 'user', f'message {i} ' + 'x' * 1000)
+    store.compact()
+    before = database_size(path)
+
+    assert store.compact(keep=10) == 390
+    assert [m['message'][:11] for m in store.tail('c', 1)] == ['message 399']
+    assert database_size(path) < before / 4
+
+
+def test_compact_converts_a_database_created_without_auto_vacuum(tmp_path):
+    path = str(tmp_path / 'history.db')
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE legacy (x)")
+    conn.close()
+
+    store = HistoryStore(path)
+    assert store._connection().execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    store.compact()
+    assert store._connection().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+@pytest.mark.parametrize('body', [
+    {'history': [{'role': 'user', 'message': 'hi'}, 'not a message']},
+    {'history': [{'role': 'user', 'message': 42}]},
+    {'history': 'not a list'},
+    ['not', 'an', 'object'],
+])
+def test_save_history_rejects_malformed_entries(chat_app, body):
+    client = chat_app.app.test_client()
+    response = client.post('/save_history', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_save_history_imports_the_history(chat_app):
+    client = chat_app.app.test_client()
+    history = [{'role': 'user', 'message': 'hi'}, {'role': 'assistant', 'message': 'hello'}]
+    assert client.post('/save_history', json={'history': history}).status_code == 200
+    with client.session_transaction() as session:
+        conversation_id = session['conversation_id']
+    assert messages(chat_app.history_store.tail(conversation_id, 10)) == [('user', 'hi'), ('assistant', 'hello')]
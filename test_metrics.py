@@ -0,0 +1,60 @@
+import time
+
+from metrics import Registry, StageTimer, STAGE_SECONDS
+
+
+def stage_sum(stage):
+    for name, labels, value in STAGE_SECONDS.samples():
+        if name.endswith('_sum') and labels == {'stage': stage}:
+            return value
+    return 0.0
+
+
+def test_stage_timer_leaves_out_paused_time():
+    def tokens():
+        with StageTimer('test_stream') as timer:
+            for token in ('a', 'b'):
+                time.sleep(0.02)
+                with timer.paused():
+                    yield token
+
+    for _ in tokens():
+        time.sleep(0.1)  # A slow consumer
+    assert 0.04 <= stage_sum('test_stream') < 0.1
+
+
+def test_render_histograms_counters_and_collectors():
+    registry = Registry()
+    requests = registry.counter('test_requests', 'Requests.', ['route'])
+    latency = registry.histogram('test_latency_seconds', 'Latency.', buckets=(0.1, 1))
+    registry.add_collector('test_component',
+                           lambda: {'state': 'open', 'inflight': 2, 'hits': 3, 'wait_seconds_total': 0.5},
+                           {'hits': ('counter', 'Hits.'), 'wait_seconds_total': ('counter', 'Waiting.'),
+                            'inflight': ('gauge', 'In flight.')})
+    requests.inc(route='/')
+    latency.observe(0.5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_requests counter' in lines
+    assert 'test_requests_total{route="/"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 0' in lines
+    assert 'test_latency_seconds_bucket{le="1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'test_latency_seconds_count 1' in lines
+    assert lines[lines.index('test_component_inflight 2') - 2:][:2] == [
+        '# HELP test_component_inflight In flight.', '# TYPE test_component_inflight gauge']
+    assert lines[lines.index('test_component_hits_total 3') - 2:][:2] == [
+        '# HELP test_component_hits Hits.', '# TYPE test_component_hits counter']
+    assert '# TYPE test_component_wait_seconds counter' in lines
+    assert 'test_component_wait_seconds_total 0.5' in lines
+    assert '# TYPE test_component_state gauge' in lines
+    assert 'test_component_state{value="open"} 1' in lines
+
+
+def test_component_counters_are_exposed_as_counters(chat_app):
+    lines = chat_app.app.test_client().get('/metrics').get_data(as_text=True).splitlines()
+    for name in ('chat_upstream_requests', 'chat_response_cache_hits', 'chat_scheduler_wait_seconds'):
+        assert f'# TYPE {name} counter' in lines
+        assert any(line.startswith(f'{name}_total ') for line in lines)
+    for name in ('chat_response_cache_entries', 'chat_scheduler_inflight', 'chat_scheduler_queue_depth'):
+        assert f'# TYPE {name} gauge' in lines
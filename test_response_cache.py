@@ -0,0 +1,291 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from response_cache import ResponseCache
+
+PARAMETERS = {'temperature': 0.7, 'top_p': 0.95}
+
+
+def run_concurrently(target, count):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def run(i):
+        barrier.wait()
+        results[i] = target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow_tokens(calls, tokens=('Hello', ' there'), delay=0.05):
+    def stream():
+        calls.append(1)
+        for token in tokens:
+            time.sleep(delay)
+            yield token
+    return stream
+
+
+def test_key_normalizes_whitespace_and_includes_parameters():
+    assert ResponseCache.key("Hi  there\n", PARAMETERS) == ResponseCache.key("Hi there", PARAMETERS)
+    assert ResponseCache.key("Hi", PARAMETERS) != ResponseCache.key("Hi", {**PARAMETERS, 'temperature': 0})
+
+
+def test_lookup_honors_ttl_and_lru_bound():
+    cache = ResponseCache(max_entries=2, ttl=0.1)
+    cache.store('a', PARAMETERS, 'A')
+    cache.store('b', PARAMETERS, 'B')
+    assert cache.lookup('a', PARAMETERS) == 'A'
+    cache.store('c', PARAMETERS, 'C')
+    assert cache.lookup('b', PARAMETERS) is None
+    time.sleep(0.15)
+    assert cache.lookup('a', PARAMETERS) is None
+
+
+def test_sampled_generations_can_opt_out():
+    cache = ResponseCache(cache_sampled=False)
+    cache.store('a', PARAMETERS, 'A')
+    assert cache.lookup('a', PARAMETERS) is None
+    cache.store('a', {'temperature': 0}, 'A')
+    assert cache.lookup('a', {'temperature': 0}) == 'A'
+
+
+def test_will_generate_is_false_for_cached_and_in_flight_prompts():
+    cache = ResponseCache()
+    assert cache.will_generate('hi', PARAMETERS)
+    leader = cache.stream_or_generate('hi', PARAMETERS, slow_tokens([]))
+    next(leader)
+    assert not cache.will_generate('hi', PARAMETERS)
+    list(leader)
+    assert not cache.will_generate('hi', PARAMETERS)
+    assert cache.will_generate('other', PARAMETERS)
+    assert ResponseCache(cache_sampled=False).will_generate('hi', PARAMETERS)
+    assert cache.stats()['misses'] == 1  # Only the leader's lookup counted
+
+
+def test_get_or_generate_coalesces_concurrent_identical_prompts():
+    cache = ResponseCache()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'reply'
+
+    results = run_concurrently(lambda _: cache.get_or_generate('hi', PARAMETERS, generate), 8)
+    assert results == ['reply'] * 8
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced']) == (1, 7)
+    assert cache.get_or_generate('hi', PARAMETERS, generate) == 'reply'
+    assert len(calls) == 1
+
+
+def test_get_or_generate_shares_the_leader_error():
+    cache = ResponseCache()
+
+    def generate():
+        time.sleep(0.1)
+        raise RuntimeError('upstream down')
+
+    def call(_):
+        try:
+            return cache.get_or_generate('hi', PARAMETERS, generate)
+        except RuntimeError as e:
+            return str(e)
+
+    assert run_concurrently(call, 4) == ['upstream down'] * 4
+    assert cache.lookup('hi', PARAMETERS) is None
+    assert cache.get_or_generate('hi', PARAMETERS, lambda: 'recovered') == 'recovered'
+
+
+def test_stream_or_generate_fans_tokens_out_to_followers():
+    cache = ResponseCache()
+    calls = []
+    stream = slow_tokens(calls)
+
+    results = run_concurrently(lambda _: list(cache.stream_or_generate('hi', PARAMETERS, stream)), 6)
+    assert results == [['Hello', ' there']] * 6
+    assert len(calls) == 1
+    assert cache.lookup('hi', PARAMETERS) == 'Hello there'
+
+
+def test_stream_and_json_requests_share_one_flight():
+    cache = ResponseCache()
+    calls = []
+    stream = slow_tokens(calls)
+
+    def call(i):
+        if i % 2:
+            return cache.get_or_generate('hi', PARAMETERS, lambda: ''.join(stream()))
+        return ''.join(cache.stream_or_generate('hi', PARAMETERS, stream))
+
+    assert run_concurrently(call, 6) == ['Hello there'] * 6
+    assert len(calls) == 1
+
+
+def test_stream_leader_disconnect_still_finishes_for_followers():
+    cache = ResponseCache()
+    calls = []
+    stream = slow_tokens(calls, tokens=('a', 'b', 'c'))
+
+    leader = cache.stream_or_generate('hi', PARAMETERS, stream)
+    assert next(leader) == 'a'
+    follower = []
+    thread = threading.Thread(target=lambda: follower.extend(cache.stream_or_generate('hi', PARAMETERS, stream)))
+    thread.start()
+    time.sleep(0.02)
+    leader.close()
+    thread.join()
+
+    assert follower == ['a', 'b', 'c']
+    assert len(calls) == 1
+    assert cache.lookup('hi', PARAMETERS) == 'abc'
+
+
+def test_stream_error_reaches_followers_and_is_not_cached():
+    cache = ResponseCache()
+
+    def stream():
+        yield 'partial'
+        time.sleep(0.05)
+        raise RuntimeError('stream broke')
+
+    def call(_):
+        parts = []
+        with pytest.raises(RuntimeError, match='stream broke'):
+            for part in cache.stream_or_generate('hi', PARAMETERS, stream):
+                parts.append(part)
+        return parts
+
+    assert run_concurrently(call, 3) == [['partial']] * 3
+    assert cache.lookup('hi', PARAMETERS) is None
+
+
+def failing_store(prompt, parameters, text):
+    raise OSError('disk full')
+
+
+def test_failed_cache_write_still_finishes_the_flight(monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(cache, 'store', failing_store)
+    calls = []
+    stream = slow_tokens(calls)
+
+    def call(i):
+        if i % 2:
+            return cache.get_or_generate('hi', PARAMETERS, lambda: ''.join(stream()))
+        return ''.join(cache.stream_or_generate('hi', PARAMETERS, stream))
+
+    assert run_concurrently(call, 6) == ['Hello there'] * 6
+    assert len(calls) == 1
+    assert cache._flights == {}
+    assert cache.get_or_generate('hi', PARAMETERS, lambda: 'again') == 'again'
+
+
+def test_disk_tier_survives_restart_and_is_bounded(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = ResponseCache(ttl=60, disk_path=path, max_disk_entries=3, purge_interval=0)
+    for i in range(5):
+        cache.store(f'p{i}', PARAMETERS, f'r{i}')
+
+    restarted = ResponseCache(ttl=60, disk_path=path)
+    assert restarted.lookup('p4', PARAMETERS) == 'r4'
+    assert restarted.lookup('p0', PARAMETERS) is None
+    assert restarted.stats()['disk_hits'] == 1
+    assert restarted._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 3
+
+
+def test_disk_tier_deletes_expired_rows(tmp_path):
+    cache = ResponseCache(ttl=0.05, disk_path=str(tmp_path / 'cache.db'))
+    cache.store('a', PARAMETERS, 'A')
+    time.sleep(0.1)
+    restarted = ResponseCache(ttl=0.05, disk_path=str(tmp_path / 'cache.db'))
+    assert restarted.lookup('a', PARAMETERS) is None
+    assert restarted._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 0
+
+
+def slow_async_tokens(calls, tokens=('Hello', ' there'), delay=0.05):
+    async def stream():
+        calls.append(1)
+        for token in tokens:
+            await asyncio.sleep(delay)
+            yield token
+    return stream
+
+
+async def collect(iterator):
+    return [part async for part in iterator]
+
+
+def test_stream_or_generate_async_coalesces_and_counts_followers():
+    cache = ResponseCache()
+    calls = []
+    stream = slow_async_tokens(calls)
+
+    async def main():
+        return await asyncio.gather(*[collect(cache.stream_or_generate_async('hi', PARAMETERS, stream))
+                                      for _ in range(6)])
+
+    assert asyncio.run(main()) == [['Hello', ' there']] * 6
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced']) == (1, 5)
+    assert cache.lookup('hi', PARAMETERS) == 'Hello there'
+
+
+def test_cancelling_the_async_leader_does_not_cancel_followers():
+    cache = ResponseCache()
+    calls = []
+    stream = slow_async_tokens(calls, tokens=('a', 'b', 'c'))
+
+    async def main():
+        leader = asyncio.create_task(collect(cache.stream_or_generate_async('hi', PARAMETERS, stream)))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(collect(cache.stream_or_generate_async('hi', PARAMETERS, stream)))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == ['a', 'b', 'c']
+    assert len(calls) == 1
+    assert cache.lookup('hi', PARAMETERS) == 'abc'
+
+
+def test_async_followers_share_a_sync_leader():
+    cache = ResponseCache()
+    calls = []
+    leader = cache.stream_or_generate('hi', PARAMETERS, slow_tokens(calls))
+    assert next(leader) == 'Hello'
+
+    async def main():
+        return await collect(cache.stream_or_generate_async('hi', PARAMETERS, slow_async_tokens(calls)))
+
+    thread = threading.Thread(target=lambda: list(leader))
+    thread.start()
+    assert asyncio.run(main()) == ['Hello', ' there']
+    thread.join()
+    assert len(calls) == 1
+
+
+def test_failed_cache_write_still_finishes_the_async_flight(monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(cache, 'store', failing_store)
+    calls = []
+    stream = slow_async_tokens(calls)
+
+    async def main():
+        return await asyncio.gather(*[collect(cache.stream_or_generate_async('hi', PARAMETERS, stream))
+                                      for _ in range(3)])
+
+    assert asyncio.run(main()) == [['Hello', ' there']] * 3
+    assert len(calls) == 1
+    assert cache._flights == {}
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from response_cache import ResponseCache
+from scheduler import SchedulerOverloaded, UpstreamScheduler
+from upstream import UpstreamClient
+
+
+def make_scheduler(**kwargs):
+    options = {'max_inflight': 1, 'max_queue': 10, 'queue_timeout': 5, 'rate': 1000, 'burst': 1000}
+    options.update(kwargs)
+    return UpstreamScheduler(**options)
+
+
+def wait_for_queue_depth(scheduler, depth):
+    deadline = time.monotonic() + 2
+    while scheduler.stats()['queue_depth'] != depth:
+        assert time.monotonic() < deadline, f"queue never reached {depth}"
+        time.sleep(0.005)
+
+
+def test_admits_immediately_below_capacity():
+    scheduler = make_scheduler(max_inflight=2)
+    assert scheduler.acquire('a') < 0.1
+    assert scheduler.acquire('b') < 0.1
+    assert scheduler.stats()['inflight'] == 2
+    scheduler.release()
+    scheduler.release()
+    assert scheduler.stats()['inflight'] == 0
+
+
+def test_queued_sessions_are_served_round_robin():
+    scheduler = make_scheduler()
+    scheduler.acquire('holder')
+    order = []
+
+    def request(session_id, label):
+        scheduler.acquire(session_id)
+        order.append(label)
+        scheduler.release()
+
+    threads = []
+    for session_id, label in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1'), ('c', 'c1')]:
+        thread = threading.Thread(target=request, args=(session_id, label))
+        thread.start()
+        threads.append(thread)
+        wait_for_queue_depth(scheduler, len(threads))
+
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    assert order == ['a1', 'b1', 'c1', 'a2', 'a3']
+
+
+def test_full_queue_fails_fast_with_retry_after():
+    scheduler = make_scheduler(max_queue=1)
+    scheduler.acquire('holder')
+    thread = threading.Thread(target=lambda: (scheduler.acquire('queued'), scheduler.release()))
+    thread.start()
+    wait_for_queue_depth(scheduler, 1)
+
+    started = time.monotonic()
+    with pytest.raises(SchedulerOverloaded, match='queue is full') as error:
+        scheduler.acquire('rejected')
+    assert time.monotonic() - started < 0.1
+    assert error.value.retry_after >= 1
+
+    scheduler.release()
+    thread.join()
+    assert scheduler.stats()['rejected'] == 1
+
+
+def test_full_queue_does_not_spend_the_session_token():
+    scheduler = make_scheduler(max_queue=0, rate=0.01, burst=1)
+    scheduler.acquire('holder')
+    with pytest.raises(SchedulerOverloaded, match='queue is full'):
+        scheduler.acquire('session')
+    scheduler.release()
+    scheduler.acquire('session')  # Its one token is still there
+
+
+def test_queue_timeout_raises_and_withdraws_the_waiter():
+    scheduler = make_scheduler(queue_timeout=0.1)
+    scheduler.acquire('holder')
+    with pytest.raises(SchedulerOverloaded, match='Timed out') as error:
+        scheduler.acquire('waiter')
+    assert error.value.retry_after >= 1
+    stats = scheduler.stats()
+    assert (stats['timed_out'], stats['queue_depth'], stats['inflight']) == (1, 0, 1)
+
+
+def test_token_bucket_limits_each_session():
+    scheduler = make_scheduler(max_inflight=10, rate=1, burst=2)
+    for _ in range(2):
+        scheduler.acquire('busy')
+        scheduler.release()
+    with pytest.raises(SchedulerOverloaded, match='this session') as error:
+        scheduler.acquire('busy')
+    assert error.value.retry_after == 1
+
+    scheduler.acquire('other')  # Other sessions have their own bucket
+    scheduler.release()
+    time.sleep(0.55)
+    with pytest.raises(SchedulerOverloaded):
+        scheduler.acquire('busy')
+    time.sleep(0.5)
+    scheduler.acquire('busy')
+
+
+def test_async_cancel_after_grant_releases_the_slot():
+    scheduler = make_scheduler()
+
+    async def main():
+        scheduler.acquire('holder')
+        waiter = asyncio.create_task(scheduler.acquire_async('waiter'))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['queue_depth'] == 1
+
+        scheduler.release()  # Grants the waiter its slot...
+        waiter.cancel()      # ...which is cancelled before it resumes
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    stats = scheduler.stats()
+    assert (stats['inflight'], stats['queue_depth']) == (0, 0)
+
+
+def test_async_cancel_while_queued_withdraws_the_waiter():
+    scheduler = make_scheduler()
+
+    async def main():
+        scheduler.acquire('holder')
+        waiter = asyncio.create_task(scheduler.acquire_async('waiter'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    stats = scheduler.stats()
+    assert (stats['inflight'], stats['queue_depth']) == (1, 0)
+
+
+def test_caps_concurrent_calls_to_a_slow_upstream(mock_upstream):
+    url, state = mock_upstream
+    state.latency = 0.2
+    scheduler = make_scheduler(max_inflight=2)
+    client = UpstreamClient(pool_size=6)
+    waits = []
+
+    def call(i):
+        with scheduler.slot(f'session{i}') as waited:
+            waits.append(waited)
+            assert client.post(url, json={'inputs': 'hi', 'parameters': {'max_new_tokens': 1}}).ok
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert time.monotonic() - started >= 0.6  # Three waves of two calls
+    assert sorted(waits)[-1] >= 0.35
+    assert state.stats()['requests'] == 6
+    assert scheduler.stats()['admitted'] == 6
+
+
+def test_get_response_answers_429_with_retry_after(chat_app, mock_upstream, monkeypatch):
+    url, _ = mock_upstream
+    monkeypatch.setattr(chat_app, 'API_URL', url)
+    monkeypatch.setattr(chat_app, 'response_cache', ResponseCache())
+    monkeypatch.setattr(chat_app, 'scheduler', make_scheduler(rate=0.2, burst=1))
+    client = chat_app.app.test_client()
+
+    response = client.post('/get_response', data={'prompt': 'hello'})
+    assert response.status_code == 200
+    assert float(response.headers['X-Queue-Wait']) < 0.1
+
+    response = client.post('/get_response', data={'prompt': 'hello again'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '5'
+
+
+def test_inference_answers_429_when_the_queue_is_full(chat_app, mock_upstream, monkeypatch):
+    url, _ = mock_upstream
+    scheduler = make_scheduler(max_queue=0)
+    monkeypatch.setattr(chat_app, 'API_URL', url)
+    monkeypatch.setattr(chat_app, 'scheduler', scheduler)
+    scheduler.acquire('holder')
+
+    response = chat_app.app.test_client().post('/api/inference', json={'inputs': 'hi'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_only_requests_that_lead_a_generation_need_a_slot(chat_app, mock_upstream, monkeypatch):
+    url, state = mock_upstream
+    scheduler = make_scheduler(max_queue=0)
+    monkeypatch.setattr(chat_app, 'API_URL', url)
+    monkeypatch.setattr(chat_app, 'response_cache', ResponseCache())
+    monkeypatch.setattr(chat_app, 'scheduler', scheduler)
+
+    # A new conversation's first turn always builds the same prompt
+    assert chat_app.app.test_client().post('/get_response', data={'prompt': 'hello'}).status_code == 200
+    scheduler.acquire('holder')
+
+    client = chat_app.app.test_client()
+    response = client.post('/get_response', data={'prompt': 'hello'})
+    assert response.status_code == 200  # Served from the cache while the only slot is taken
+    assert response.headers['X-Queue-Wait'] == '0.000'
+    assert state.stats()['requests'] == 1
+
+    assert client.post('/get_response', data={'prompt': 'something new'}).status_code == 429
+    with client.session_transaction() as session:
+        conversation_id = session['conversation_id']
+    history = chat_app.history_store.tail(conversation_id, 10)
+    assert [row['message'] for row in history if row['role'] == 'user'] == ['hello']
+    assert scheduler.stats()['inflight'] == 1
@@ -0,0 +1,43 @@
+import time
+
+from session_store import MemorySessionBackend, SQLiteSessionBackend
+
+
+def test_memory_session_expiry_slides_on_use():
+    backend = MemorySessionBackend(ttl=0.2)
+    backend.set('sid', {'conversation_id': 'c'})
+    for _ in range(4):
+        time.sleep(0.1)
+        assert backend.get('sid') == {'conversation_id': 'c'}
+    time.sleep(0.25)
+    assert backend.get('sid') is None
+
+
+def test_sqlite_session_expiry_slides_on_use(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'), ttl=0.4)
+    backend.set('sid', {'conversation_id': 'c'})
+    for _ in range(5):
+        time.sleep(0.15)
+        assert backend.get('sid') == {'conversation_id': 'c'}
+    time.sleep(0.45)
+    assert backend.get('sid') is None
+
+
+def test_memory_sessions_are_evicted_least_recently_used_first():
+    backend = MemorySessionBackend(max_entries=2)
+    backend.set('a', {})
+    backend.set('b', {})
+    backend.get('a')
+    backend.set('c', {})
+    assert backend.get('a') == {}
+    assert backend.get('b') is None
+
+
+def test_sqlite_sessions_purge_expired_rows_on_save(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'), ttl=0.05, purge_interval=0.1)
+    for i in range(5):
+        backend.set(f'old{i}', {})
+    time.sleep(0.15)
+    backend.set('new', {})
+    sids = [row[0] for row in backend._connection().execute("SELECT sid FROM sessions")]
+    assert sids == ['new']
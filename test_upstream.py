@@ -0,0 +1,161 @@
+import asyncio
+import email.utils
+import threading
+import time
+
+import pytest
+
+from upstream import AsyncUpstreamClient, CircuitBreaker, UpstreamClient, UpstreamUnavailable, _retry_delay
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    results = []
+    barrier = threading.Barrier(8)
+
+    def call():
+        barrier.wait()
+        results.append(breaker.allow())
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_breaker_trial_result_closes_or_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_retry_delay_uses_jittered_backoff():
+    delays = [_retry_delay(None, attempt=2, backoff=0.5, max_backoff=10) for _ in range(50)]
+    assert all(0 <= delay <= 2.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retry_delay_adds_jitter_on_top_of_retry_after():
+    delays = [_retry_delay('3', attempt=0, backoff=0.5, max_backoff=10) for _ in range(50)]
+    assert all(3 <= delay <= 3.5 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retry_delay_accepts_http_date():
+    retry_at = email.utils.formatdate(time.time() + 5, usegmt=True)
+    assert 3 <= _retry_delay(retry_at, attempt=0, backoff=0.5, max_backoff=10) <= 6.5
+
+
+def test_retry_delay_gives_up_on_long_retry_after():
+    assert _retry_delay('120', attempt=0, backoff=0.5, max_backoff=10) is None
+
+
+def test_client_retries_then_opens_breaker(mock_upstream):
+    url, state = mock_upstream
+    state.error_rate = 1.0
+    client = UpstreamClient(max_retries=2, backoff=0.01, breaker=CircuitBreaker(failure_threshold=1))
+
+    response = client.post(url, json={'inputs': 'hi'})
+    assert response.status_code == 503
+    assert state.stats()['requests'] == 3
+    assert client.stats()['retries'] == 2
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(UpstreamUnavailable):
+        client.post(url, json={'inputs': 'hi'})
+    assert client.stats()['short_circuited'] == 1
+    assert state.stats()['requests'] == 3
+
+
+def test_client_does_not_wait_out_long_retry_after(mock_upstream):
+    url, state = mock_upstream
+    state.throttle_rate = 1.0  # Answers 429 with Retry-After: 1
+    client = UpstreamClient(max_retries=2, backoff=0.01, max_backoff=0.5)
+
+    response = client.post(url, json={'inputs': 'hi'})
+    assert response.status_code == 429
+    assert state.stats()['requests'] == 1
+
+
+def test_client_reuses_connections(mock_upstream):
+    url, _ = mock_upstream
+    client = UpstreamClient()
+    for _ in range(3):
+        assert client.post(url, json={'inputs': 'hi'}).status_code == 200
+    stats = client.stats()
+    assert stats['connections_opened'] == 1
+    assert stats['connections_reused'] == 2
+
+
+def half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    return breaker
+
+
+def test_cancelled_async_trial_releases_the_breaker(mock_upstream):
+    url, state = mock_upstream
+    state.latency = 1.0
+    breaker = half_open_breaker()
+
+    async def main():
+        client = AsyncUpstreamClient(breaker=breaker)
+        call = asyncio.create_task(client.post(url, json={'inputs': 'hi'}))
+        await asyncio.sleep(0.1)
+        assert not breaker.allow()  # The trial is in flight
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        await client.aclose()
+
+    asyncio.run(main())
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()  # The next call becomes the trial
+
+
+def test_interrupted_sync_trial_releases_the_breaker(monkeypatch):
+    client = UpstreamClient(breaker=half_open_breaker())
+
+    def interrupted(url, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(client.session, 'post', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        client.post('http://127.0.0.1:9/model', json={'inputs': 'hi'})
+    assert client.breaker.state == CircuitBreaker.HALF_OPEN
+    assert client.breaker.allow()
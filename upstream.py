@@ -0,0 +1,355 @@
+"""Shared HTTP clients for calls to the HuggingFace Inference API."""
+import asyncio
+import contextlib
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from metrics import STAGE_SECONDS, time_stage
+
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    """Raised instead of calling the upstream while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures until a cool-down has passed.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    rejects calls for `reset_timeout` seconds. It then lets a single trial
+    call through (half-open); success closes it again, failure re-opens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Return True if a call may go to the upstream now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def holds_trial(self):
+        """Return True while a half-open trial call is outstanding."""
+        with self._lock:
+            return self._state == self.HALF_OPEN and self._trial_in_flight
+
+    def release(self):
+        """Give up the half-open trial without an outcome, e.g. when the call was cancelled.
+
+        The next call is then let through as the trial instead.
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logging.warning("Circuit breaker opened for HuggingFace API.")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with time_stage('upstream_connect'):
+            super().connect()
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with time_stage('upstream_connect'):
+            super().connect()
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class UpstreamClient:
+    """Pooled keep-alive client with deadlines, retries and a circuit breaker.
+
+    Requests that come back with 429 or 503 are retried with jittered
+    exponential backoff, honoring `Retry-After` when the upstream sends it.
+    """
+
+    RETRY_STATUSES = (429, 503)
+
+    # Kind and help text of each stats() key, for the /metrics collector
+    STATS = {
+        'requests': ('counter', 'Requests sent to the upstream, including retries.'),
+        'retries': ('counter', 'Requests retried after a 429 or 503.'),
+        'failures': ('counter', 'Upstream calls that failed or answered 429 or 5xx.'),
+        'short_circuited': ('counter', 'Calls rejected while the circuit breaker was open.'),
+        'connections_opened': ('counter', 'Upstream connections opened.'),
+        'connections_reused': ('counter', 'Requests sent on an already open connection.'),
+        'breaker_state': ('gauge', 'Circuit breaker state.')
+    }
+
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=2, backoff=0.5, max_backoff=10.0, breaker=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        # Time new connections (TCP + TLS) as the upstream_connect stage
+        self.adapter.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool
+        }
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._counters = {'requests': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def post(self, url, **kwargs):
+        """POST to the upstream, retrying on 429/503 and failing fast when degraded."""
+        if not self.breaker.allow():
+            self._count('short_circuited')
+            raise UpstreamUnavailable("HuggingFace API is unavailable (circuit open)")
+
+        trial = self.breaker.holds_trial()
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        try:
+            while True:
+                self._count('requests')
+                try:
+                    response = self.session.post(url, **kwargs)
+                except requests.exceptions.RequestException:
+                    self._count('failures')
+                    self.breaker.record_failure()
+                    raise
+                STAGE_SECONDS.observe(response.elapsed.total_seconds(), stage='upstream_ttfb')
+
+                if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                    delay = self._retry_delay(response, attempt)
+                    if delay is not None:
+                        logging.warning(f"HuggingFace API returned {response.status_code}, "
+                                        f"retrying in {delay:.2f}s")
+                        response.close()
+                        self._count('retries')
+                        time.sleep(delay)
+                        attempt += 1
+                        continue
+
+                if response.status_code >= 500 or response.status_code == 429:
+                    self._count('failures')
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return response
+        except BaseException:
+            if trial:
+                self.breaker.release()  # Don't leave the breaker waiting on a trial that never reported
+            raise
+
+    def _retry_delay(self, response, attempt):
+        """Seconds to wait before the next attempt, or None if it is not worth waiting."""
+        return _retry_delay(response.headers.get('Retry-After'), attempt, self.backoff, self.max_backoff)
+
+    def stats(self):
+        """Return request counters, connection pool reuse and breaker state."""
+        connections = pooled_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({
+            'connections_opened': connections,
+            'connections_reused': max(pooled_requests - connections, 0),
+            'breaker_state': self.breaker.state
+        })
+        return stats
+
+
+class AsyncUpstreamClient:
+    """Non-blocking counterpart of UpstreamClient for the async serving mode.
+
+    Uses the same retry policy and can share the circuit breaker of the
+    sync client. Requires httpx.
+    """
+
+    RETRY_STATUSES = UpstreamClient.RETRY_STATUSES
+    STATS = UpstreamClient.STATS
+
+    def __init__(self, pool_size=100, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=2, backoff=0.5, max_backoff=10.0, breaker=None):
+        import httpx
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+        self._counters = {'requests': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0}
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url, **kwargs):
+        """POST to the upstream and yield the response before its body is read."""
+        import httpx
+
+        if not self.breaker.allow():
+            self._counters['short_circuited'] += 1
+            raise UpstreamUnavailable("HuggingFace API is unavailable (circuit open)")
+
+        connect_started = None
+
+        async def trace(event, info):
+            # Time new connections (TCP + TLS) as the upstream_connect stage
+            nonlocal connect_started
+            if event == 'connection.connect_tcp.started':
+                connect_started = time.perf_counter()
+            elif event in ('connection.start_tls.complete', 'connection.connect_tcp.complete') \
+                    and connect_started is not None:
+                if event == 'connection.start_tls.complete' or not url.startswith('https'):
+                    STAGE_SECONDS.observe(time.perf_counter() - connect_started, stage='upstream_connect')
+                    connect_started = None
+
+        trial = self.breaker.holds_trial()
+        attempt = 0
+        try:
+            while True:
+                self._counters['requests'] += 1
+                request = self.client.build_request('POST', url, extensions={'trace': trace}, **kwargs)
+                started = time.perf_counter()
+                try:
+                    response = await self.client.send(request, stream=True)
+                except httpx.HTTPError:
+                    self._counters['failures'] += 1
+                    self.breaker.record_failure()
+                    raise
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage='upstream_ttfb')
+
+                if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                    delay = _retry_delay(response.headers.get('Retry-After'), attempt,
+                                         self.backoff, self.max_backoff)
+                    if delay is not None:
+                        logging.warning(f"HuggingFace API returned {response.status_code}, "
+                                        f"retrying in {delay:.2f}s")
+                        await response.aclose()
+                        self._counters['retries'] += 1
+                        await asyncio.sleep(delay)
+                        attempt += 1
+                        continue
+
+                if response.status_code >= 500 or response.status_code == 429:
+                    self._counters['failures'] += 1
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                break
+        except BaseException:
+            if trial:
+                # A cancelled trial would otherwise keep the shared breaker half-open for good
+                self.breaker.release()
+            raise
+
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def post(self, url, **kwargs):
+        """POST to the upstream and return the response with its body read."""
+        async with self.stream(url, **kwargs) as response:
+            await response.aread()
+            return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self):
+        """Return request counters and breaker state."""
+        stats = dict(self._counters)
+        stats['breaker_state'] = self.breaker.state
+        return stats
+
+
+def _retry_delay(retry_after, attempt, backoff, max_backoff):
+    """Seconds to wait before the next attempt, or None if it is not worth waiting.
+
+    Uses exponential backoff with full jitter. A Retry-After header up to
+    `max_backoff` is a floor that the jitter is added on top of, so clients
+    throttled together do not all retry at the same instant.
+    """
+    jitter = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    if retry_after:
+        delay = _parse_retry_after(retry_after)
+        if delay is not None:
+            return delay + jitter if delay <= max_backoff else None
+    return jitter
+
+
+def _parse_retry_after(value):
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)